@@ -22,49 +22,489 @@
 # THE SOFTWARE.
 
 import time
-from threading import Timer, RLock
-import Adafruit_GPIO.GPIO as GPIO
+from array import array
+from collections import deque
+from Queue import Queue
+from threading import Thread, Event, Timer, Lock, RLock
+
+# Values of the Adafruit_GPIO.GPIO constants, the gpio object is passed in
+IN = 1
+HIGH = True
+LOW = False
+BOTH = 3
+PUD_OFF = 0
+PUD_UP = 2
 
 UNPRESSED = 0
 CLICK = 2
 DOUBLECLICK = 3
 LONG_START = 4
 LONG_END =5
+MULTICLICK = 6
+LONG_DURING = 7
+
+# ButtonBank flags
+EDGE = 1
+
+# Gesture table: kinds of state, they pick the timeout a sample is checked against
+_NONE = 0
+_DOWN = 1
+_UP = 2
+_LONG = 3
+
+# Gesture table: actions
+_STAY = 0
+_START = 1
+_CLICKS = 2
+_LONG_START = 3
+_LONG_REPEAT = 4
+_LONG_END = 5
+
+
+def compileGestures(maxClicks):
+    """
+    Build the transition table for up to maxClicks clicks.
+    States are IDLE, LONG, then DOWN/UP pairs for each click count. A sample
+    is a symbol pressed*3 + timeClass, where timeClass is 0 before the first
+    timeout of the state, 1 between the two and 2 past the last one.
+    Returns (kinds, table) with table[state*6 + symbol] = (next, action, clicks)
+    """
+    IDLE, LONG = 0, 1
+    down = lambda k: 2*k      # k = 1..maxClicks
+    up = lambda k: 2*k + 1    # k = 1..maxClicks-1
+    count = 2*maxClicks + 1
+    kinds = [_NONE, _LONG] + [_NONE] * (count - 2)
+    table = [None] * (count * 6)
+
+    def on(state, pressed, timeClasses, entry):
+        for tc in timeClasses:
+            table[state*6 + pressed*3 + tc] = entry
+
+    on(IDLE, 0, (0, 1, 2), (IDLE, _STAY, 0))
+    on(IDLE, 1, (0, 1, 2), (down(1), _START, 0))
+    on(LONG, 0, (0, 1, 2), (IDLE, _LONG_END, 0))
+    on(LONG, 1, (0, 1), (LONG, _STAY, 0))
+    on(LONG, 1, (2,), (LONG, _LONG_REPEAT, 0))
+    for k in range(1, maxClicks + 1):
+        released = (up(k), _STAY, 0) if k < maxClicks else (IDLE, _CLICKS, k)
+        if k == 1: # Debounce and long press only on the first press
+            kinds[down(k)] = _DOWN
+            on(down(k), 0, (0,), (IDLE, _STAY, 0))
+            on(down(k), 0, (1, 2), released)
+            on(down(k), 1, (0, 1), (down(k), _STAY, 0))
+            on(down(k), 1, (2,), (LONG, _LONG_START, 0))
+        else:
+            on(down(k), 0, (0, 1, 2), released)
+            on(down(k), 1, (0, 1, 2), (down(k), _STAY, 0))
+        if k < maxClicks:
+            kinds[up(k)] = _UP
+            on(up(k), 0, (0, 1), (up(k), _STAY, 0))
+            on(up(k), 1, (0, 1), (down(k + 1), _START, 0))
+            on(up(k), 0, (2,), (IDLE, _CLICKS, k))
+            on(up(k), 1, (2,), (IDLE, _CLICKS, k))
+    return kinds, table
+
+
+class ButtonBank(object):
+    """
+    A group of Buttons sampled together: one input_pins() call and one
+    timestamp per tick, with the state of every button kept in flat arrays
+    and advanced through a compiled gesture table
+    """
+    _debounceTicks = 100
+    _longRepeatTicks = 50 # shortest duringLongPress interval when edge driven
+
+    def __init__(self, gpio, maxClicks=2, dispatcher=None):
+        self._gpio = gpio
+        self._dispatcher = dispatcher # None runs callbacks inline
+        self._lock = RLock()
+        self._kinds, self._table = compileGestures(maxClicks)
+        self._buttons = []
+        self._pins = []
+        self._pressedLevel = []
+        self._clickTicks = array('d')
+        self._pressTicks = array('d')
+        self._repeatTicks = array('d')
+        self._state = array('B')
+        self._startTime = array('d')
+        self._flags = array('B')
+        # (indexes, pins, levels when nothing is pressed) of the buttons sampled
+        # by tick(), replaced as a whole so samplers see a consistent set
+        self._polling = ([], [], [])
+        # Chords as (bit mask of button indexes, callback), and who is long pressed
+        self._chords = []
+        self._longMask = 0
+
+    def add(self, button, clickTicks, pressTicks, repeatTicks=0):
+        with self._lock:
+            index = len(self._buttons)
+            self._buttons.append(button)
+            self._pins.append(button.pin)
+            self._pressedLevel.append(button._buttonPressed)
+            self._clickTicks.append(clickTicks)
+            self._pressTicks.append(pressTicks)
+            self._repeatTicks.append(repeatTicks)
+            self._state.append(0)
+            self._startTime.append(0)
+            self._flags.append(0)
+            self._updatePolled()
+        return index
+
+    def attachChord(self, buttons, newFunc):
+        """
+        Call newFunc(pins) once each time all the buttons are long pressed together
+        """
+        mask = 0
+        for button in buttons:
+            mask |= 1 << button._index
+        self._chords.append((mask, newFunc))
+
+    def _updatePolled(self):
+        polled = [i for i in range(len(self._buttons)) if not self._flags[i] & EDGE]
+        self._polling = (polled, [self._pins[i] for i in polled],
+                         [self._buttons[i]._buttonReleased for i in polled])
+
+    def _setFlag(self, index, flag, on):
+        with self._lock:
+            if on:
+                self._flags[index] |= flag
+            else:
+                self._flags[index] &= ~flag
+            self._updatePolled()
+
+    def tick(self):
+        """
+        Sample every polled button and advance their state machines
+        """
+        polling = self._polling
+        if not polling[1]:
+            return
+        self._advance(polling, self._gpio.input_pins(polling[1]), time.time()*1000)
+
+    def _advance(self, polling, levels, now):
+        # Step the polled buttons with levels sampled at now
+        polled, pins, idleLevels = polling
+        with self._lock:
+            state = self._state
+            if levels == idleLevels:
+                # Nothing pressed, only buttons in the middle of a gesture move
+                for i in polled:
+                    if state[i]:
+                        self._step(i, False, now)
+                return
+            pressedLevel = self._pressedLevel
+            for n, i in enumerate(polled):
+                if state[i] or levels[n] == pressedLevel[i]:
+                    self._step(i, levels[n] == pressedLevel[i], now)
+
+    def tickButton(self, index):
+        with self._lock:
+            if not self._flags[index] & EDGE:
+                level = self._gpio.input(self._pins[index])
+                self._step(index, level == self._pressedLevel[index], time.time()*1000)
+
+    def deadline(self):
+        """
+        Earliest time.time() a polled button times out, None when none can
+        """
+        deadlines = [self._deadline(i) for i in self._polling[0] if self._state[i]]
+        deadlines = [d for d in deadlines if d is not None]
+        # Timeouts compare with >, be 1ms late rather than early
+        return (min(deadlines) + 1) / 1000.0 if deadlines else None
+
+    def _deadline(self, index):
+        # When the current state of a button can time out, None if it cannot
+        kind = self._kinds[self._state[index]]
+        if kind == _DOWN:
+            return self._startTime[index] + self._pressTicks[index]
+        elif kind == _UP:
+            return self._startTime[index] + self._clickTicks[index]
+        elif kind == _LONG:
+            return self._startTime[index] + max(self._repeatTicks[index], self._longRepeatTicks)
+        return None
+
+    def _step(self, i, pressed, now):
+        state = self._state[i]
+        kind = self._kinds[state]
+        t = now - self._startTime[i]
+        if kind == _DOWN:
+            timeClass = (t >= self._debounceTicks) + (t > self._pressTicks[i])
+        elif kind == _UP:
+            timeClass = 2 if t > self._clickTicks[i] else 0
+        elif kind == _LONG:
+            timeClass = 2 if t >= self._repeatTicks[i] else 0
+        else:
+            timeClass = 0
+        state, action, clicks = self._table[state*6 + pressed*3 + timeClass]
+        self._state[i] = state
+        if action == _STAY:
+            return
+        elif action == _START:
+            self._startTime[i] = now
+        elif action == _CLICKS:
+            self._buttons[i]._emit(CLICK, now, clicks)
+            if pressed: # Pressed again after the click timed out, a new gesture starts
+                self._step(i, pressed, now)
+        elif action == _LONG_REPEAT:
+            self._startTime[i] = now
+            self._buttons[i]._emit(LONG_DURING, now)
+        elif action == _LONG_START:
+            self._startTime[i] = now
+            self._longMask |= 1 << i
+            self._buttons[i]._emit(LONG_START, now)
+            for mask, func in self._chords:
+                if mask & (1 << i) and self._longMask & mask == mask:
+                    pins = tuple(self._pins[n] for n in range(len(self._pins)) if mask & (1 << n))
+                    self._call(func, (pins,), now)
+        elif action == _LONG_END:
+            self._longMask &= ~(1 << i)
+            self._buttons[i]._emit(LONG_END, now)
+
+    def _call(self, func, args, now, coalesce=False):
+        if self._dispatcher is None:
+            func(*args)
+        else:
+            self._dispatcher.dispatch(func, args, now, coalesce)
+
+
+class EventDispatcher(object):
+    """
+    Runs button callbacks on worker threads, so a slow callback never holds up
+    sampling. A coalesced event (duringLongPress) is dropped while the same
+    callback for the same button is still queued. Keeps the delay from the
+    gesture to the callback and the callback run time per callback.
+    """
+
+    def __init__(self, workers=1):
+        self._queue = Queue()
+        self._lock = Lock()
+        self._pending = set()
+        self._stats = {}
+        self._workers = []
+        for i in range(workers):
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def dispatch(self, func, args, now, coalesce=False):
+        key = None
+        if coalesce:
+            key = (func, args)
+            with self._lock:
+                queued = key in self._pending
+                self._pending.add(key)
+            if queued:
+                self._record(func, coalesced=True)
+                return
+        self._queue.put((func, args, now, key))
+
+    def stop(self):
+        """
+        End the workers once the callbacks queued so far have run
+        """
+        for worker in self._workers:
+            self._queue.put(None)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            func, args, now, key = item
+            if key is not None:
+                with self._lock:
+                    self._pending.discard(key)
+            start = time.time()*1000
+            failed = False
+            try:
+                func(*args)
+            except Exception: # A failing callback must not kill the worker
+                failed = True
+            self._record(func, start - now, time.time()*1000 - start, failed=failed)
+
+    def _record(self, func, latency=0, runTime=0, coalesced=False, failed=False):
+        name = getattr(func, '__name__', repr(func))
+        with self._lock:
+            stat = self._stats.get(name)
+            if stat is None:
+                stat = self._stats[name] = {'count': 0, 'coalesced': 0, 'errors': 0, 'latency_total': 0.0,
+                                            'latency_max': 0.0, 'run_total': 0.0, 'run_max': 0.0}
+            if coalesced:
+                stat['coalesced'] += 1
+                return
+            stat['count'] += 1
+            stat['errors'] += failed
+            stat['latency_total'] += latency
+            stat['latency_max'] = max(stat['latency_max'], latency)
+            stat['run_total'] += runTime
+            stat['run_max'] = max(stat['run_max'], runTime)
+
+    def stats(self):
+        """
+        Per callback name: calls, coalesced events, errors and latency/run time in ms
+        """
+        with self._lock:
+            return dict((name, dict(stat)) for name, stat in self._stats.items())
+
+    def qsize(self):
+        return self._queue.qsize()
+
+
+class ButtonSampler(Thread):
+    """
+    Samples the polled buttons of a ButtonBank in its own thread and records
+    each level change with its timestamp. drain() replays them through the
+    gesture table, so a busy consumer delays the callbacks but never changes
+    how a press is timed.
+    """
+
+    def __init__(self, bank, period=0.01, size=256, onSample=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self._bank = bank
+        self._period = period
+        self._onSample = onSample
+        # deque append/popleft are atomic, producer and consumer need no lock
+        self._samples = deque(maxlen=size)
+        self._last = None
+        self._stopped = Event()
+        # How late each tick ran compared with its period, and samples the
+        # consumer lost because the deque was full
+        self._ticks = 0
+        self._jitterTotal = 0.0
+        self._jitterMax = 0.0
+        self._dropped = 0
+
+    def run(self):
+        gpio = self._bank._gpio
+        last = None
+        due = time.time()*1000
+        while not self._stopped.is_set():
+            now = time.time()*1000
+            late = max(now - due, 0)
+            self._ticks += 1
+            self._jitterTotal += late
+            self._jitterMax = max(self._jitterMax, late)
+            polling = self._bank._polling
+            if polling[1]:
+                levels = gpio.input_pins(polling[1])
+                if (polling, levels) != last: # A new set of pins counts as a change
+                    if len(self._samples) == self._samples.maxlen:
+                        self._dropped += 1
+                    self._samples.append((now, polling, levels))
+                    last = (polling, levels)
+                    if self._onSample:
+                        self._onSample()
+            due = time.time()*1000 + self._period*1000
+            self._stopped.wait(self._period)
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        """
+        Ticks, average and worst lateness of a tick in ms, and dropped samples
+        """
+        ticks = self._ticks
+        return {'ticks': ticks, 'jitter_avg': self._jitterTotal / ticks if ticks else 0.0,
+                'jitter_max': self._jitterMax, 'dropped': self._dropped, 'queued': len(self._samples)}
+
+    def drain(self):
+        """
+        Feed the recorded samples to the bank, then check timeouts against now
+        """
+        samples = self._samples
+        while samples:
+            now, polling, levels = samples.popleft()
+            self._timeOut(now)
+            self._bank._advance(polling, levels, now)
+            self._last = (polling, levels)
+        now = time.time()*1000
+        self._timeOut(now)
+        if self._last is not None:
+            polling, levels = self._last
+            self._bank._advance(polling, levels, now)
+
+    def _timeOut(self, until):
+        # Step the gestures in progress at every deadline before until with the
+        # levels they had then, as tick() would have when the consumer is late
+        if self._last is None:
+            return
+        polling, levels = self._last
+        bank = self._bank
+        previous = None
+        while True:
+            deadline = bank.deadline()
+            if deadline is None or deadline*1000 >= until or deadline == previous:
+                return
+            bank._advance(polling, levels, deadline*1000)
+            previous = deadline
+
 
 class OneButton(object):
     """
     A Class representing one phisical Button
     """
-    _debounceTicks = 100
 
-    def __init__(self, gpio, pin, activeLow=True, clickTicks=600, pressTicks=1000, pullUp=True):
+    def __init__(self, gpio, pin, activeLow=True, clickTicks=600, pressTicks=1000, pullUp=True,
+                 bank=None, maxClicks=2, repeatTicks=0, dispatcher=None):
         self._pin = pin
         self._gpio = gpio
         self._activeLow = activeLow
-        self._clickTicks = clickTicks
-        self._pressTicks = pressTicks
-        self._state = 0
-        self._isLongPressed = False
         self._lastChangeTime = 0
         self._lastState = UNPRESSED
-        self._startTime = 0
+        self._lastClicks = 0
+        self._timer = None
 
         # CallBackFunctions
         self._clickFunc = None
         self._doubleClickFunc = None
+        self._multiClickFunc = None
         self._longPressStartFunc = None
         self._longPressStopFunc = None
         self._duringLongPressFunc = None
 
+        self._setLevels(activeLow)
+
+        # init GPIO
+        self._gpio.setup(pin, IN, pull_up_down= PUD_UP if pullUp else PUD_OFF)
+
+        # A button on its own is a bank of one, maxClicks and dispatcher are
+        # the bank's when given one
+        self._bank = bank if bank is not None else ButtonBank(gpio, maxClicks, dispatcher)
+        self._index = self._bank.add(self, clickTicks, pressTicks, repeatTicks)
+
+    def _setLevels(self, activeLow):
         if activeLow:
-            self._buttonReleased = GPIO.HIGH
-            self._buttonPressed = GPIO.LOW
+            self._buttonReleased = HIGH
+            self._buttonPressed = LOW
         else:
-            self._buttonReleased = GPIO.LOW
-            self._buttonPressed = GPIO.HIGH
+            self._buttonReleased = LOW
+            self._buttonPressed = HIGH
 
-        # init GPIO
-        self._gpio.setup(pin, GPIO.IN, pull_up_down= GPIO.PUD_UP if pullUp else GPIO.PUD_OFF)
+    def setPin(self, pin, activeLow=True, pullUp=True):
+        """
+        Move the button to another pin or polarity, keeping its callbacks,
+        chords and place in the bank. A gesture in progress is dropped.
+        """
+        bank = self._bank
+        edge = bank._flags[self._index] & EDGE
+        if edge:
+            self.disableEdgeDetect()
+        with bank._lock:
+            self._pin = pin
+            self._activeLow = activeLow
+            self._setLevels(activeLow)
+            self._gpio.setup(pin, IN, pull_up_down= PUD_UP if pullUp else PUD_OFF)
+            i = self._index
+            bank._pins[i] = pin
+            bank._pressedLevel[i] = self._buttonPressed
+            bank._state[i] = 0
+            bank._longMask &= ~(1 << i)
+            bank._updatePolled()
+        if edge:
+            self.enableEdgeDetect()
 
     def attachClick(self, newFunc):
         self._clickFunc = newFunc
@@ -72,6 +512,10 @@ class OneButton(object):
     def attachDoubleClick(self, newFunc):
         self._doubleClickFunc =  newFunc
 
+    def attachMultiClick(self, newFunc):
+        # Called as newFunc(pin, clicks) for 3 clicks or more
+        self._multiClickFunc = newFunc
+
     def attachLongPressStart(self, newFunc):
         self._longPressStartFunc = newFunc
 
@@ -82,62 +526,76 @@ class OneButton(object):
         self._duringLongPressFunc = newFunc
 
     def isLongPressed(self):
-        return self._isLongPressed
+        return self._bank._state[self._index] == 1
+
+    def enableEdgeDetect(self):
+        """
+        Run the state machine from GPIO edges and timers instead of tick()
+        """
+        self._bank._setFlag(self._index, EDGE, True)
+        self._gpio.add_event_detect(self._pin, BOTH)
+        self._gpio.add_event_callback(self._pin, self._onEdge)
+
+    def disableEdgeDetect(self):
+        self._gpio.remove_event_detect(self._pin)
+        with self._bank._lock:
+            self._bank._setFlag(self._index, EDGE, False)
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+    def _onEdge(self, pin):
+        bank = self._bank
+        with bank._lock:
+            if not bank._flags[self._index] & EDGE:
+                return
+            now = time.time()*1000
+            bank._step(self._index, self._gpio.input(self._pin) == self._buttonPressed, now)
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            # Wake up again when the current state can time out
+            deadline = bank._deadline(self._index)
+            if deadline is None:
+                return
+            self._timer = Timer(max(deadline - now + 1, 0) / 1000.0, self._onEdge, [self._pin])
+            self._timer.daemon = True
+            self._timer.start()
 
     def tick(self):
-        buttonLevel = self._gpio.input(self._pin)
-        now = time.time()*1000
+        self._bank.tickButton(self._index)
+
+    def _emit(self, event, now, clicks=0):
+        # Called by the bank with the gesture that just completed at now
+        call = self._bank._call
+        if event == LONG_DURING:
+            if self._duringLongPressFunc:
+                call(self._duringLongPressFunc, (self._pin,), now, coalesce=True)
+            return
+        if event == CLICK and clicks == 2:
+            event = DOUBLECLICK
+        elif event == CLICK and clicks > 2:
+            event = MULTICLICK
+        self._lastState = event
+        self._lastClicks = clicks
+        self._lastChangeTime = time.time()
+        if event == MULTICLICK:
+            if self._multiClickFunc:
+                call(self._multiClickFunc, (self._pin, clicks), now)
+            return
+        if event == CLICK:
+            func = self._clickFunc
+        elif event == DOUBLECLICK:
+            func = self._doubleClickFunc
+        elif event == LONG_START:
+            func = self._longPressStartFunc
+        else:
+            func = self._longPressStopFunc
+        if func:
+            call(func, (self._pin,), now)
+        if event == LONG_START and self._duringLongPressFunc:
+            call(self._duringLongPressFunc, (self._pin,), now, coalesce=True)
 
-        if self._state == 0:
-            if buttonLevel == self._buttonPressed:
-                self._state = 1
-                self._startTime = now
-
-        elif self._state == 1:
-            if buttonLevel == self._buttonReleased and (now - self._startTime) < self._debounceTicks:
-                self._state = 0
-            elif buttonLevel == self._buttonReleased:
-                self._state = 2
-            elif buttonLevel == self._buttonPressed and (now - self._startTime) > self._pressTicks:
-                self._isLongPressed = True
-                self._lastState = LONG_START
-                self._lastChangeTime = time.time()
-                if self._longPressStartFunc:
-                    self._longPressStartFunc(self._pin)
-                if self._duringLongPressFunc:
-                    self._duringLongPressFunc(self._pin)
-                self._state = 6
-
-        elif self._state == 2:
-            if (now - self._startTime) > self._clickTicks:
-                self._lastState = CLICK
-                self._lastChangeTime = time.time()
-                if self._clickFunc:
-                    self._clickFunc(self._pin)
-                self._state = 0
-            elif buttonLevel == self._buttonPressed:
-                self._state = 3
-
-        elif self._state == 3:
-            if buttonLevel == self._buttonReleased:
-                self._lastState = DOUBLECLICK
-                self._lastChangeTime = time.time()
-                if self._doubleClickFunc:
-                    self._doubleClickFunc(self._pin)
-                self._state = 0
-
-        elif self._state == 6:
-            if buttonLevel == self._buttonReleased:
-                self._isLongPressed = False
-                self._lastState = LONG_END
-                self._lastChangeTime = time.time()
-                if self._longPressStopFunc:
-                    self._longPressStopFunc(self._pin)
-                self._state = 0
-            else:
-                self._isLongPressed = True
-                if self._duringLongPressFunc:
-                    self._duringLongPressFunc(self._pin)
     @property
     def pin(self):
         return self._pin
@@ -146,6 +604,10 @@ class OneButton(object):
     def lastState(self):
         return self._lastState
 
+    @property
+    def lastClicks(self):
+        return self._lastClicks
+
     @property
     def lastChangeTime(self):
         return self._lastChangeTime
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+'''
+Benchmarks of pylcd2 and OneButton on the simulated bus and GPIO of
+simulate.py, runs on any Linux box:
+
+    python benchmark.py [--idle SECONDS] [--json]
+
+lcd_button itself needs SIP, its loop is reproduced here with the same
+pieces (sampler, dispatcher, lcd_puts).
+'''
+
+import argparse
+import json
+import os
+import time
+from threading import Event, Thread
+
+import pylcd2
+import OneButton
+import simulate
+
+PAGES = [('   SIP - status ', '     Idle       '),
+         ('  Prg 1 - 1-3   ', ' 192.168.1.20   '),
+         ('    CPU temp    ', '    48.3 C      '),
+         ('  Date & time   ', '2016-01-01 12:00')]
+
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def bench_lcd(timing, frames):
+    '''Frames per second and bus traffic per frame of a page rotation'''
+    bus = simulate.SMBus()
+    lcd = pylcd2.lcd(0x27, 1, timing=timing, bus=bus)
+    before = bus.stats()
+    start = time.time()
+    for n in range(frames):
+        page = PAGES[n % len(PAGES)]
+        lcd.lcd_puts(page[0], 1)
+        lcd.lcd_puts(page[1], 2)
+    lcd.sync()
+    elapsed = time.time() - start
+    after = bus.stats()
+    assert bus.screen() == list(PAGES[(frames - 1) % len(PAGES)]), bus.screen()
+    bus_time = after['bus_time'] - before['bus_time']
+    return {'frames': frames,
+            'fps': frames / elapsed,
+            'bus_fps': frames / bus_time if bus_time else None, # Limit set by the 100kHz bus
+            'bytes_per_frame': float(after['bytes'] - before['bytes']) / frames,
+            'transactions_per_frame': float(after['transactions'] - before['transactions']) / frames,
+            'violations': after['violations'] - before['violations']}
+
+
+def bench_contention(transactions):
+    '''Wait of control transactions on a bus kept busy by display refreshes'''
+    bus = simulate.SMBus()
+    lcd = pylcd2.lcd(0x27, 1, timing=pylcd2.lcd.TIMING_ADAPTIVE, bus=bus)
+    scheduler = pylcd2.bus_scheduler(bus)
+    running = Event()
+    running.set()
+
+    def refresh():
+        n = 0
+        while running.is_set():
+            page = PAGES[n % len(PAGES)]
+            lcd.lcd_puts(page[0], 1)
+            lcd.lcd_puts(page[1], 2)
+            lcd.sync()
+            n += 1
+    thread = Thread(target=refresh)
+    thread.start()
+    waits = []
+    for i in range(transactions):
+        start = time.time()
+        scheduler.transaction(lambda bus: bus.write_byte(0x20, i & 0xFF), pylcd2.i2c_scheduler.PRIORITY_CONTROL)
+        waits.append((time.time() - start) * 1000)
+        time.sleep(0.005)
+    running.clear()
+    thread.join()
+    stats = scheduler.stats()
+    return {'control_avg_ms': sum(waits) / len(waits), 'control_max_ms': max(waits),
+            'utilisation': stats['utilisation'], 'merged': stats['merged']}
+
+
+def bench_tick(buttons, ticks):
+    '''Cost of one ButtonBank.tick() with nothing and with one button pressed'''
+    gpio = simulate.ScriptedGPIO()
+    bank = OneButton.ButtonBank(gpio)
+    pins = range(1, buttons + 1)
+    for pin in pins:
+        OneButton.OneButton(gpio, pin, bank=bank)
+    result = {}
+    for name, level in (('idle_us', simulate.HIGH), ('pressed_us', simulate.LOW)):
+        gpio.set(pins[0], level)
+        start = time.time()
+        for i in range(ticks):
+            bank.tick()
+        result[name] = (time.time() - start) / ticks * 1e6
+    gpio.set(pins[0], simulate.HIGH)
+    return result
+
+
+class Loop(object):
+    '''
+    The LCDSender loop without SIP: replays the sampler, sleeps until the
+    next button deadline or page refresh, and redraws the page when due.
+    '''
+
+    def __init__(self, edge, refresh=2.0):
+        self.gpio = simulate.ScriptedGPIO()
+        self.lcd = pylcd2.lcd(0x27, 1, timing=pylcd2.lcd.TIMING_ADAPTIVE, bus=simulate.SMBus())
+        self.wake = Event()
+        self.refresh = refresh
+        self.clicks = []
+        self.dispatcher = OneButton.EventDispatcher()
+        self.bank = OneButton.ButtonBank(self.gpio, dispatcher=self.dispatcher)
+        self.button = OneButton.OneButton(self.gpio, 40, clickTicks=200, pressTicks=1000, bank=self.bank)
+        self.button.attachClick(self._click)
+        self.sampler = OneButton.ButtonSampler(self.bank, 0.01, onSample=self.wake.set)
+        if edge:
+            self.button.enableEdgeDetect()
+        else:
+            self.sampler.start()
+
+    def _click(self, pin):
+        self.clicks.append(time.time())
+        self.wake.set()
+
+    def run(self, seconds):
+        end = time.time() + seconds
+        due = 0
+        while time.time() < end:
+            now = time.time()
+            self.sampler.drain()
+            if now >= due:
+                lines = PAGES[0] # Refreshed but unchanged, as most pages are
+                self.lcd.lcd_puts(lines[0], 1)
+                self.lcd.lcd_puts(lines[1], 2)
+                due = now + self.refresh
+            deadlines = [d for d in (due, self.bank.deadline(), end) if d is not None]
+            self.wake.wait(max(0, min(deadlines) - time.time()))
+            self.wake.clear()
+        self.sampler.stop()
+
+
+def bench_latency(edge, clicks):
+    '''Delay from the end of a click gesture to its callback'''
+    loop = Loop(edge)
+    presses = [(0.1 + 0.6 * n, 0.15) for n in range(clicks)] # Longer than the debounce
+    player = loop.gpio.play(simulate.presses(40, presses))
+    loop.run(presses[-1][0] + 0.6)
+    player.join()
+    # A single click is complete clickTicks after it was pressed
+    pressed = [t for t, pin, level in loop.gpio.changes if level == simulate.LOW]
+    latencies = [(c - p - 0.2) * 1000 for p, c in zip(pressed, loop.clicks)]
+    return {'clicks': len(loop.clicks), 'expected': clicks,
+            'latency_avg_ms': sum(latencies) / len(latencies) if latencies else None,
+            'latency_max_ms': max(latencies) if latencies else None}
+
+
+def bench_idle(edge, seconds):
+    '''CPU seconds per minute of the loop with nothing pressed'''
+    loop = Loop(edge, refresh=1.0)
+    start = cpu_time()
+    loop.run(seconds)
+    return {'cpu_s_per_min': (cpu_time() - start) * 60 / seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LCD and button benchmarks on simulated hardware')
+    parser.add_argument('--idle', type=float, default=10, help='seconds of each idle CPU run')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    for name, timing, frames in (('fixed', pylcd2.lcd.TIMING_FIXED, 40),
+                                 ('adaptive', pylcd2.lcd.TIMING_ADAPTIVE, 400),
+                                 ('busy', pylcd2.lcd.TIMING_BUSY, 400)):
+        results['lcd_' + name] = bench_lcd(timing, frames)
+    results['contention'] = bench_contention(200)
+    results['tick_2_buttons'] = bench_tick(2, 20000)
+    results['tick_16_buttons'] = bench_tick(16, 20000)
+    for name, edge in (('polled', False), ('edge', True)):
+        results['latency_' + name] = bench_latency(edge, 5)
+        results['idle_' + name] = bench_idle(edge, args.idle)
+
+    if args.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+        return
+    for name in sorted(results):
+        print name
+        for key, value in sorted(results[name].items()):
+            print '    %-24s %s' % (key, '%.3f' % value if isinstance(value, float) else value)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,20 @@
 # This plugin required python pylcd2.py library
 
 
-from threading import Thread
-from Queue import Queue
+from threading import Thread, Event, Lock
+from collections import deque
 from random import randint
 import json
 import time
+import heapq
+import itertools
 import sys
 import traceback
+import bisect
+try:
+    import numpy # Optional, only speeds up get_sip_status on big boards
+except ImportError:
+    numpy = None
 
 import web
 import gv  # Get access to sip's settings
@@ -20,11 +27,13 @@ from helpers import uptime, get_ip, get_cpu_temp, get_rpi_revision, stop_station
 from blinker import signal
 import pylcd2
 import Adafruit_GPIO.GPIO as GPIO
-import OneButton
+import lcd_display
 
 # Add a new url to open the data entry page.
 urls.extend(['/lcd-button', 'plugins.lcd_button.settings',
              '/lcd-buttonj', 'plugins.lcd_button.settings_json',
+             '/lcd-button-logj', 'plugins.lcd_button.status_json',
+             '/lcd-button-metricsj', 'plugins.lcd_button.metrics_json',
              '/ulcd-but', 'plugins.lcd_button.update'])
 
 # Add this plugin to the home page plugins menu
@@ -35,225 +44,669 @@ gv.plugin_menu.append(['LCD-Button Settings', '/lcd-button'])
 ################################################################################
 
 
-TICK_DELAY = 0.05
+REFRESH_TIME = 2 # Seconds between page refreshes
+MESSAGE_TIME = 2 # Seconds a queued message stays on screen
+WATCHDOG_TIME = 5 # Seconds between re-asserting the manual pump state
+STATUS_ENTRIES = 100 # Status log entries kept, the oldest are dropped
+
+
+class Histogram(object):
+    """Count, total, max and a coarse distribution of durations in ms."""
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000) # Upper bucket limits
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(self.BOUNDS) + 1) # Last one is everything above
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.buckets[bisect.bisect_left(self.BOUNDS, ms)] += 1
+
+    def snapshot(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'avg': self.total / self.count if self.count else 0.0,
+                'buckets': zip([str(b) for b in self.BOUNDS] + ['inf'], self.buckets)}
+
+
+class Metrics(object):
+    """Named counters and duration histograms, cheap enough to leave on."""
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, ms):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(ms)
+
+    def snapshot(self):
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'histograms': dict((name, h.snapshot()) for name, h in self._histograms.iteritems())}
+
+
+class ProviderCache(Thread):
+    """
+    Values of slow system queries (IP, CPU temperature...) kept fresh by a
+    background thread, so rendering a page is a dictionary lookup. A value is
+    only refreshed while something keeps reading it.
+    """
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self._lock = Lock()
+        self._wake = Event()
+        self._providers = {} # name: (function, ttl)
+        self._values = {}
+        self._expires = {}
+        self._read = set() # Read since their last refresh
+        self.start()
+
+    def register(self, name, func, ttl, default='...'):
+        with self._lock:
+            self._providers[name] = (func, ttl)
+            self._values.setdefault(name, default)
+            self._expires[name] = 0
+
+    def get(self, name):
+        with self._lock:
+            self._read.add(name)
+            if self._expires[name] <= time.time():
+                self._wake.set()
+            return self._values[name]
+
+    def run(self):
+        while True:
+            now = time.time()
+            with self._lock:
+                due = [name for name in self._read if self._expires[name] <= now]
+                self._read.difference_update(due)
+            for name in due:
+                func, ttl = self._providers[name]
+                try:
+                    value = func()
+                except Exception:
+                    value = self._values[name] # Keep the last good value
+                with self._lock:
+                    self._values[name] = value
+                    self._expires[name] = time.time() + ttl
+            with self._lock:
+                pending = [self._expires[name] for name in self._read]
+            # Values nobody reads are left to expire, get() wakes us up for them
+            self._wake.wait(max(0, min(pending) - time.time()) if pending else None)
+            self._wake.clear()
+
+
+class Page(object):
+    """
+    A screen of the button rotation. content() returns its two lines, it is
+    called again every interval seconds (never again when interval is None)
+    and the LCD is only written when the lines changed.
+    """
+
+    def __init__(self, name, content, interval=REFRESH_TIME):
+        self.name = name
+        self.content = content
+        self.interval = interval
+
+
+lcd_pages = []
+
+def find_page(name):
+    for page in lcd_pages:
+        if page.name == name:
+            return page
+    return None
+
+def register_page(name, content, interval=REFRESH_TIME, position=None):
+    """Add a page to the rotation, other plugins can add their own."""
+    page = Page(name, content, interval)
+    if position is None:
+        lcd_pages.append(page)
+    else:
+        lcd_pages.insert(position, page)
+    return page
+
+
+class Dialog(object):
+    """
+    A modal screen: two lines, the buttons that answer it and an optional
+    timeout. options maps a button pin to the function to call when it is
+    clicked (None just closes the dialog).
+    """
+
+    def __init__(self, lines, options=None, timeout=None, on_timeout=None):
+        self.lines = lines
+        self.options = options or {}
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.timer = None
+
+
+class ConfigStore(object):
+    """
+    The plugin settings, read from the file once and then kept in memory.
+    set() validates the new values, writes them through to the file and
+    calls every listener with the keys that changed.
+    """
+    DEFAULTS = {
+        'use_lcd': False,
+        'enable_manual_master': False,
+        'lcd_adress': 0x27,
+        'lcd_timing': pylcd2.lcd.TIMING_ADAPTIVE,
+        'lcd_hw_scroll': False,
+        'lcd_process': False,
+        'extra_displays': [],
+        'but1_pin': 40,           #Red Button
+        'but1_NormalOpen': True,
+        'but2_pin': 38,         #Black Button
+        'but2_NormalOpen': False,
+        'but_edge_detect': False
+    }
+    RANGES = {
+        'lcd_adress': (0x03, 0x77),
+        'lcd_timing': (pylcd2.lcd.TIMING_FIXED, pylcd2.lcd.TIMING_BUSY),
+        'but1_pin': (1, 40),
+        'but2_pin': (1, 40)
+    }
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+        self._listeners = []
+        self._data = dict(self.DEFAULTS)
+        try:
+            with open(path, 'r') as f:  # Read the settings from file
+                file_data = json.load(f)
+            for key, value in file_data.iteritems():
+                if key in self._data:
+                    try:
+                        self._data[key] = self._validate(key, value)
+                    except ValueError:
+                        pass # Keep the default
+        except Exception:
+            pass
+
+    def _validate(self, key, value):
+        if isinstance(self.DEFAULTS[key], bool):
+            return bool(value)
+        if isinstance(self.DEFAULTS[key], list):
+            value = [str(v) for v in (value if isinstance(value, list) else [value])]
+            if key == 'extra_displays':
+                lcd_display.parse_panels(value, 1) # Raises ValueError
+            return value
+        value = int(value)
+        low, high = self.RANGES.get(key, (value, value))
+        if not low <= value <= high:
+            raise ValueError('%s must be between %d and %d' % (key, low, high))
+        return value
+
+    def get(self):
+        """A copy of the settings."""
+        with self._lock:
+            return dict(self._data)
+
+    def subscribe(self, func):
+        """Call func(changed_keys) after every set() that changed something."""
+        self._listeners.append(func)
+
+    def set(self, values):
+        """
+        Validate and save values, unknown keys are ignored. Returns the keys
+        that changed, raises ValueError and changes nothing when a value is
+        not valid.
+        """
+        clean = dict((key, self._validate(key, value))
+                     for key, value in values.iteritems() if key in self.DEFAULTS)
+        with self._lock:
+            changed = [key for key, value in clean.iteritems() if self._data[key] != value]
+            if not changed:
+                return changed
+            self._data.update(clean)
+            with open(self._path, 'w') as f:  # write the settings to file
+                json.dump(self._data, f)
+        for func in self._listeners:
+            func(changed)
+        return changed
+
+
+class MessageQueue(object):
+    """
+    Bounded priority queue for the SIP messages. A message put with the key
+    of one still waiting replaces its text in place, so a program that
+    changes stations several times only shows its latest state. HIGH
+    messages are taken before NORMAL ones, when the queue is full the
+    oldest message of the lowest priority is dropped.
+    """
+    NORMAL = 0
+    HIGH = 1
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._items = {} # key -> [priority, seq, text, time queued]
+        self._seq = itertools.count()
+        self._lock = Lock()
+
+    def put(self, text, key=None, priority=NORMAL):
+        with self._lock:
+            seq = next(self._seq)
+            if key is None:
+                key = (None, seq) # Never coalesced
+            item = self._items.get(key)
+            if item is not None: # Keep its place in the line
+                item[0] = max(item[0], priority)
+                item[2] = text
+                metrics.count('messages.coalesced')
+                return
+            self._items[key] = [priority, seq, text, time.time()]
+            metrics.count('messages.queued')
+            if len(self._items) > self.maxsize:
+                del self._items[min(self._items, key=lambda k: self._items[k][:2])]
+                metrics.count('messages.dropped')
+
+    def get(self, prefer=None):
+        """Returns (key, text) of the next message, None when empty."""
+        with self._lock:
+            if not self._items:
+                return None
+            key = min(self._items, key=lambda k: (-self._items[k][0], self._items[k][1]))
+            if prefer in self._items and self._items[prefer][0] >= self._items[key][0]:
+                key = prefer
+            item = self._items.pop(key)
+        metrics.observe('messages.wait', (time.time() - item[3]) * 1000)
+        return key, item[2]
+
+    def preempts(self, key):
+        """True when a newer state of key or a HIGH message is waiting."""
+        with self._lock:
+            return key in self._items or \
+                any(item[0] > self.NORMAL for item in self._items.itervalues())
+
+    def qsize(self):
+        return len(self._items)
+
 
 class LCDSender(Thread):
-    def __init__(self, queue):
+    def __init__(self, queue, config):
         Thread.__init__(self)
         self.daemon = True
-        self.status = ''
+        self._status = deque(maxlen=STATUS_ENTRIES)
+        self._status_seq = itertools.count(1)
+        self._status_lock = Lock()
         self._m_queue = queue
+        self._config = config
         self._text_shift = 0
-        self._lcd = None
+        self._display = None
         self._manual_mode = False
-        self._sleep_time = 0
-        self._but1 = None # Black
-        self._but2 = None # Red
+        self._changes = set() # Settings changed since the last loop
+        self._changes_lock = Lock()
+        self._hold_until = 0
+        self._message_key = None # Key of the message on the screen
+        self._next_refresh = 0
+        self._shown = None
+        self._manual_request = False
+        self._manual_master_start = 0
+        self._watchdog = None
+        self._dialog = None
+        self._clicks = deque()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._timer_lock = Lock()
+        self._wake = Event()
 
         self._params = self.get_lcd_parms()
-        self._but1 = OneButton.OneButton(gv.scontrol.board_gpio, self._params['but1_pin'],
-                                           activeLow = self._params['but1_NormalOpen']) # Black
-        self._but2 = OneButton.OneButton(gv.scontrol.board_gpio, self._params['but2_pin'],
-                                           activeLow = self._params['but2_NormalOpen']) # Red
-        self._lcd = pylcd2.lcd(self._params['lcd_adress'], 1 if get_rpi_revision() >= 2 else 0)
-        self._but1.attachClick(self._butClick)
-        self._but2.attachClick(self._butClick)
+        if self._params['use_lcd']: # Disabled, the buttons are not even sampled
+            self._display = self._open_display()
+        self._panels = None
+        self._panel_pages = [] # [key, page name, next refresh, lines shown] of the extra panels
+        self._open_panels()
+        config.subscribe(self.update)
 
         self.start()
 
-    def _butClick(self,pin):
-        if pin == self._but1.pin:
-            if self._text_shift == 7:
-                self._text_shift = 0
-            else:
-                self._text_shift += 1
-
-    def add_status(self, msg):
-        if self.status:
-            self.status += '\n' + msg
+    def _open_display(self):
+        # The LCD and the buttons, in a worker process when asked for
+        if self._params['lcd_process']:
+            display = lcd_display.DisplayProcess
         else:
-            self.status = msg
-
-    def update(self):
-        self._sleep_time = 0
+            display = lcd_display.LocalDisplay
+        return display(gv.scontrol.board_gpio, self._params, 1 if get_rpi_revision() >= 2 else 0,
+                       self._butClick, self._butChord, self._wake.set, self._display_error)
+
+    def _open_panels(self):
+        # The extra displays, each showing one page
+        if self._panels is not None:
+            self._panels.close()
+        self._panels = lcd_display.DisplayManager(self._params['lcd_timing'], self._params['lcd_hw_scroll'])
+        self._panel_pages = []
+        port = 1 if get_rpi_revision() >= 2 else 0
+        for n, spec in enumerate(lcd_display.parse_panels(self._params['extra_displays'], port)):
+            self._panels.add(n, spec)
+            self._panel_pages.append([n, spec['page'], 0, None])
+
+    def _refresh_panels(self, now):
+        # Show the pages of the extra displays that are due, returns the next due time
+        due = []
+        for entry in self._panel_pages:
+            key, name, next_refresh, shown = entry
+            if next_refresh is None:
+                continue
+            if now >= next_refresh:
+                page = find_page(name)
+                lines = tuple(page.content()) if page else ('Unknown page', name)
+                if lines != shown:
+                    self._panels.show(key, lines)
+                    entry[3] = lines
+                next_refresh = entry[2] = None if page is None or page.interval is None else now + page.interval
+            if next_refresh is not None:
+                due.append(next_refresh)
+        return min(due) if due else None
+
+    def _display_error(self, err_string):
+        self.add_status('LCD-Button display encountered error: ' + err_string, error = True)
+
+    def _apply_changes(self):
+        # Only the hardware whose settings changed is set up again
+        with self._changes_lock:
+            changed = self._changes
+            self._changes = set()
+        self._params = self.get_lcd_parms()
+        if changed & set(['extra_displays', 'lcd_timing', 'lcd_hw_scroll']):
+            self._open_panels()
+        if not self._params['use_lcd']:
+            if self._display is not None:
+                self._display.close()
+                self._display = None
+            reopened = False
+        elif self._display is None or 'lcd_process' in changed:
+            if self._display is not None:
+                self._display.close()
+            self._display = self._open_display()
+            reopened = True
+        else:
+            reopened = self._display.configure(self._params, changed)
+        if reopened:
+            self._shown = None
+            self._next_refresh = 0
+        self.add_status('Settings changed: ' + ', '.join(sorted(changed)), 'config')
 
-    def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0:
-            time.sleep(1)
-            self._sleep_time -= 1
+    def _butClick(self,pin):
+        # Handled on the LCDSender thread, dialogs act on SIP state
+        self._clicks.append(pin)
+        self._wake.set()
+
+    def _handle_click(self, pin):
+        if self._dialog is not None:
+            self._dialog_click(pin)
+        elif pin == self._params['but1_pin']:
+            self._text_shift = (self._text_shift + 1) % len(lcd_pages)
+
+    def _butChord(self, pins): # Both buttons long pressed
+        self._manual_request = True
+        self._wake.set()
+
+    def add_status(self, msg, page=None, error=False):
+        entry = {'id': next(self._status_seq), 'time': time.time(), 'page': page,
+                 'text': msg, 'error': error}
+        with self._status_lock:
+            self._status.append(entry)
+
+    @property
+    def status(self):
+        """The status log as text, oldest first."""
+        with self._status_lock:
+            return '\n'.join(entry['text'] for entry in self._status)
+
+    def status_entries(self, offset=0, limit=20):
+        """Returns (total, entries) of the status log, newest first."""
+        with self._status_lock:
+            entries = list(self._status)
+        entries.reverse()
+        return len(entries), entries[offset:offset + limit]
+
+    def update(self, changed):
+        """Called by the config store with the keys that were saved."""
+        with self._changes_lock:
+            self._changes.update(changed)
+        self._wake.set()
+
+    def wake(self):
+        self._wake.set()
+
+    def _wait(self, deadline):
+        # Sleep until deadline (None for ever) or until something calls wake()
+        start = time.time()
+        self._wake.wait(None if deadline is None else max(0, deadline - start))
+        self._wake.clear()
+        metrics.observe('loop.sleep', (time.time() - start) * 1000)
+
+    def call_later(self, delay, func, *args):
+        """Run func(*args) on this thread after delay seconds, returns a handle for cancel()."""
+        timer = [time.time() + delay, next(self._timer_seq), func, args]
+        with self._timer_lock:
+            heapq.heappush(self._timers, timer)
+        self._wake.set()
+        return timer
+
+    def cancel(self, timer):
+        if timer is not None:
+            timer[2] = None
+
+    def _run_timers(self, now):
+        while True:
+            with self._timer_lock:
+                if not self._timers or self._timers[0][0] > now:
+                    return
+                when, seq, func, args = heapq.heappop(self._timers)
+            if func is None:
+                continue
+            try:
+                func(*args)
+            except Exception: # One failing timer must not hold up the others
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                err_string = ''.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
+                self.add_status('LCD-Button timer encountered error: ' + err_string, error = True)
+
+    def open_dialog(self, dialog):
+        """Show dialog until one of its buttons is clicked or it times out."""
+        self.close_dialog()
+        self._dialog = dialog
+        if dialog.timeout is not None:
+            dialog.timer = self.call_later(dialog.timeout, self._dialog_timeout, dialog)
+        self._wake.set()
+
+    def close_dialog(self):
+        if self._dialog is not None:
+            self.cancel(self._dialog.timer)
+            self._dialog = None
+            self._shown = None # Redraw the page
+            self._next_refresh = time.time()
+            self._wake.set()
+
+    def _dialog_timeout(self, dialog):
+        if self._dialog is dialog:
+            self.close_dialog()
+            if dialog.on_timeout:
+                dialog.on_timeout()
+
+    def _dialog_click(self, pin):
+        dialog = self._dialog
+        if pin in dialog.options:
+            self.close_dialog()
+            if dialog.options[pin]:
+                dialog.options[pin]()
 
     def set_manual_mode(self):
-        lcd = self._lcd
-        lcd.lcd_clear()
-        lcd.lcd_puts('{:^15}'.format("Activar Bomba Manualmente?"), 1)
-        lcd.lcd_puts('   SI  Cancelar', 2)
-        start_wait = time.time()
-        while ((time.time() - start_wait ) < 10) or \
-                (self._but2.lastState == OneButton.CLICK and (self._but2.lastChangeTime > start_wait)): # Wait 10 secs or cancel
-            self._but1.tick()
-            self._but2.tick()
-            if self._but1.lastState == OneButton.CLICK and (self._but1.lastChangeTime > start_wait):
-                self._manual_mode = True
-                lcd.lcd_clear()
-                lcd.lcd_puts('{:^15}'.format("Iniciando Bomba"), 1)
-                lcd.lcd_puts('{:^15}'.format("Manualmente"), 2)
-                time.sleep(2)
-                stop_stations()
-                gv.sd['mm'] = 0
-                gv.sd['en'] = 0
-                vals = [0] * len(gv.srvals)
-                vals[gv.sd['mas'] - 1] = 1 # Start Pump
-                gv.srvals = vals
-                set_output()
-                manual_master_start = time.time()
-                # now we wait to cancel with other double press
-                last_update = time.time()
-                while True:
-                    time.sleep(TICK_DELAY)
-                    self._but1.tick()
-                    self._but2.tick()
-                    if (time.time() - last_update) > 5:
-                        # Keep Forcing the current State!
-                        gv.sd['mm'] = 0
-                        gv.sd['en'] = 0
-                        vals = [0] * len(gv.srvals)
-                        vals[gv.sd['mas'] - 1] = 1
-                        gv.scontrol.stations = vals
-                        run_min = int((time.time() - manual_master_start)/60)
-                        run_sec = int((time.time() - manual_master_start)%60)
-                        lcd.lcd_clear()
-                        lcd.lcd_puts('{:^15}'.format("Cancelar Bomba Manual?"), 1)
-                        lcd.lcd_puts(' Cancel - {:^3}:{}'.format(run_min,run_sec), 2)
-                        last_update = time.time()
-                    if self._but1.lastState == OneButton.CLICK and self._but1.lastChangeTime > manual_master_start: # Cancel Manual Mode
-                        lcd.lcd_clear()
-                        lcd.lcd_puts('{:^15}'.format("Detentiendo Bomba"), 1)
-                        lcd.lcd_puts('{:^15}'.format("Modo Automatico"), 2)
-                        time.sleep(3)
-                        stop_stations()
-                        gv.srvals = [0] * len(gv.srvals)
-                        set_output()
-                        gv.sd['mm'] = 0
-                        gv.sd['en'] = 1
-                        break
-
-
+        self.open_dialog(Dialog(('{:^15}'.format("Activar Bomba Manualmente?"), '   SI  Cancelar'),
+                                {self._params['but1_pin']: self._manual_start, self._params['but2_pin']: None}, # SI / Cancel
+                                timeout = 10))
+
+    def _manual_start(self):
+        self._manual_mode = True
+        self.open_dialog(Dialog(('{:^15}'.format("Iniciando Bomba"), '{:^15}'.format("Manualmente")),
+                                timeout = 2, on_timeout = self._manual_run))
+
+    def _manual_run(self):
+        stop_stations()
+        gv.sd['mm'] = 0
+        gv.sd['en'] = 0
+        vals = [0] * len(gv.srvals)
+        vals[gv.sd['mas'] - 1] = 1 # Start Pump
+        gv.srvals = vals
+        set_output()
+        self._manual_master_start = time.time()
+        self.open_dialog(Dialog(('{:^15}'.format("Cancelar Bomba Manual?"), ''),
+                                {self._params['but1_pin']: self._manual_stop})) # Cancel Manual Mode
+        self._manual_watchdog()
+
+    def _manual_watchdog(self):
+        # Keep Forcing the current State! Scheduled first so an error does not end it
+        self._watchdog = self.call_later(WATCHDOG_TIME, self._manual_watchdog)
+        gv.sd['mm'] = 0
+        gv.sd['en'] = 0
+        vals = [0] * len(gv.srvals)
+        vals[gv.sd['mas'] - 1] = 1
+        gv.scontrol.stations = vals
+        run_min = int((time.time() - self._manual_master_start)/60)
+        run_sec = int((time.time() - self._manual_master_start)%60)
+        if self._dialog is not None:
+            self._dialog.lines = (self._dialog.lines[0], ' Cancel - {:^3}:{}'.format(run_min,run_sec))
+
+    def _manual_stop(self):
+        self.cancel(self._watchdog)
+        self._watchdog = None
+        self.open_dialog(Dialog(('{:^15}'.format("Detentiendo Bomba"), '{:^15}'.format("Modo Automatico")),
+                                timeout = 3, on_timeout = self._manual_end))
+
+    def _manual_end(self):
+        stop_stations()
+        gv.srvals = [0] * len(gv.srvals)
+        set_output()
+        gv.sd['mm'] = 0
+        gv.sd['en'] = 1
+        self._manual_mode = False
 
     def run(self):
         time.sleep(randint(3, 10))  # Sleep some time to prevent printing before startup information
         print "LCD Button plugin is active"
         old_text_index = -1
-        last_update  = 0
-        self._params = self.get_lcd_parms()
         while True:
             try:
+                if self._changes:
+                    self._apply_changes()
                 now = time.time()
                 if not self._params['use_lcd'] :                      # if LCD plugin is disable
-                    self._sleep(5)
+                    self._wait(None)
                     continue
 
-                self._but1.tick()
-                self._but2.tick()
-                if self._but1.isLongPressed() and self._but2.isLongPressed() and self._params['enable_manual_master']: # Double push!
-                    self.set_manual_mode()
-                if (now - self._but1.lastChangeTime) > 60: # Return displaying the default
+                self._display.poll()
+                while self._clicks:
+                    self._handle_click(self._clicks.popleft())
+                self._run_timers(now)
+                if self._manual_request: # Double push!
+                    self._manual_request = False
+                    if self._params['enable_manual_master'] and self._dialog is None and not self._manual_mode:
+                        self.set_manual_mode()
+                if (now - self._display.last_activity()) > 60: # Return displaying the default
                     self._text_shift = 0
-                if old_text_index != self._text_shift or self._m_queue.qsize() > 0 or (now - last_update) > 2 : #Update every 2 seconds
-                    last_update = now
+                if self._dialog is not None:
+                    self._display.lcd_puts(self._dialog.lines[0], 1)
+                    self._display.lcd_puts(self._dialog.lines[1], 2)
+                elif (now >= self._hold_until and
+                        (old_text_index != self._text_shift or self._m_queue.qsize() > 0 or
+                         (self._next_refresh is not None and now >= self._next_refresh))) or \
+                        (now < self._hold_until and self._m_queue.preempts(self._message_key)) : # Page is due or the message changed
                     old_text_index = self._text_shift
                     self.get_LCD_print(self._text_shift)   # Print to LCD 16x2
-                time.sleep(TICK_DELAY)
+                self._display.scroll()
+                panels_due = self._refresh_panels(now)
+
+                # Sleep until the next thing that is due, a button, a message or
+                # a settings change wake us up earlier
+                if self._dialog is not None:
+                    refresh = None
+                elif self._hold_until > now:
+                    refresh = self._hold_until
+                else:
+                    refresh = self._next_refresh
+                deadlines = [refresh, self._display.next_scroll(), self._display.deadline(), panels_due]
+                if self._text_shift:
+                    deadlines.append(self._display.last_activity() + 60)
+                if self._timers:
+                    deadlines.append(self._timers[0][0])
+                deadlines = [d for d in deadlines if d is not None]
+                self._wait(min(deadlines) if deadlines else None)
 
             except Exception:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 err_string = ''.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
-                self.add_status('LCD-Button plugin encountered error: ' + err_string)
-                self._sleep(60)
+                self.add_status('LCD-Button plugin encountered error: ' + err_string, error = True)
+                self._wait(time.time() + 60)
 
     def get_LCD_print(self, report):
-        lcd = self._lcd
-        if self._m_queue.qsize() > 0:
-            lcd.lcd_clear()
+        lcd = self._display
+        start = time.time()
+        item = self._m_queue.get(self._message_key)
+        if item is not None:
+            self._message_key = item[0]
+            msg = '{:^15}'.format(item[1])
             lcd.lcd_puts('{:^15}'.format("SIP - Messages"), 1)
-            lcd.lcd_puts('{:^15}'.format(self._m_queue.get()), 2)
-            self.add_status('SIP / new message')
-            time.sleep(2)
-        elif report == 0:
-            lcd.lcd_clear()
-            lcd.lcd_puts('{:^15}'.format("SIP - status"), 1)
-            lcd.lcd_puts('{:^15}'.format(get_sip_status()), 2)
-            self.add_status('SIP / Irrigation syst.')
-        elif report == 1:
-            lcd.lcd_clear()
-            lcd.lcd_puts("Software SIP:", 1)
-            lcd.lcd_puts(gv.ver_date, 2)
-            self.add_status('Software SIP: / ' + gv.ver_date)
-        elif report == 2:
-            lcd.lcd_clear()
-            ip = get_ip()
-            lcd.lcd_puts("My IP is:", 1)
-            lcd.lcd_puts(str(ip), 2)
-            self.add_status('My IP is: / ' + str(ip))
-        elif report == 3:
-            lcd.lcd_clear()
-            lcd.lcd_puts("Port IP:", 1)
-            lcd.lcd_puts("8080", 2)
-            self.add_status('Port IP: / 8080')
-        elif report == 4:
-            lcd.lcd_clear()
-            temp = get_cpu_temp(gv.sd['tu']) + ' ' + gv.sd['tu']
-            lcd.lcd_puts("CPU temperature:", 1)
-            lcd.lcd_puts(temp, 2)
-            self.add_status('CPU temperature: / ' + temp)
-        elif report == 5:
-            lcd.lcd_clear()
-            da = time.strftime('%d.%m.%Y', time.gmtime(gv.now))
-            ti = time.strftime('%H:%M:%S', time.gmtime(gv.now))
-            lcd.lcd_puts(da, 1)
-            lcd.lcd_puts(ti, 2)
-            self.add_status(da + ' ' + ti)
-        elif report == 6:
-            lcd.lcd_clear()
-            up = uptime()
-            lcd.lcd_puts("System run time:", 1)
-            lcd.lcd_puts(up, 2)
-            self.add_status('System run time: / ' + up)
-        elif report == 7:
-            lcd.lcd_clear()
-            if gv.sd['rs']:
-                rain_sensor = "Active"
-            else:
-                rain_sensor = "Inactive"
-            lcd.lcd_puts("Rain sensor:", 1)
-            lcd.lcd_puts(rain_sensor, 2)
-            self.add_status('Rain sensor: / ' + rain_sensor)
+            lcd.lcd_puts(msg, 2)
+            self.add_status('SIP / new message', 'message')
+            self._hold_until = time.time() + MESSAGE_TIME + lcd.scroll_time(msg)
+            self._shown = None # Redraw the page after the message
+            self._next_refresh = self._hold_until
+            metrics.observe('render.message', (time.time() - start) * 1000)
+        else:
+            self._message_key = None
+            page = lcd_pages[report % len(lcd_pages)]
+            lines = tuple(page.content())
+            if (page, lines) != self._shown: # Only touch the LCD when the page changed
+                lcd.lcd_puts(lines[0], 1)
+                lcd.lcd_puts(lines[1], 2)
+                self._shown = (page, lines)
+                self.add_status(' / '.join(line.strip() for line in lines), page.name)
+            self._next_refresh = None if page.interval is None else time.time() + page.interval
+            metrics.observe('render.' + page.name, (time.time() - start) * 1000)
+
+    def metrics(self):
+        """The plugin metrics with the LCD, button and message queue figures."""
+        data = metrics.snapshot()
+        if self._display is not None:
+            data.update(self._display.stats())
+        data['panels'] = self._panels.stats()
+        data['message_queue'] = self._m_queue.qsize()
+        return data
 
     def get_lcd_parms(self):
-        """Returns the data form file."""
-        datalcd = {
-            'use_lcd': False,
-            'enable_manual_master': False,
-            'lcd_adress': 0x27,
-            'status': self.status,
-            'but1_pin': 40,           #Red Button
-            'but1_NormalOpen': True,
-            'but2_pin': 38,         #Black Button
-            'but2_NormalOpen': False
-        }
-        try:
-            with open('./data/lcd_button.json', 'r') as f:  # Read the settings from file
-                file_data = json.load(f)
-            for key, value in file_data.iteritems():
-                if key in datalcd:
-                    datalcd[key] = value
-        except Exception:
-            pass
-
+        """Returns the settings from the config store."""
+        datalcd = self._config.get()
+        datalcd['status'] = self.status
         return datalcd
 
-message_queue = Queue()
-checker = LCDSender(message_queue)
+metrics = Metrics()
+providers = ProviderCache()
+providers.register('ip', get_ip, 30)
+providers.register('cpu_temp', lambda: get_cpu_temp(gv.sd['tu']) + ' ' + gv.sd['tu'], 5)
+providers.register('uptime', uptime, 5)
+
+config = ConfigStore('./data/lcd_button.json')
+message_queue = MessageQueue()
+checker = LCDSender(message_queue, config)
 
 def get_lcd_options():
     datalcd = checker.get_lcd_parms()
@@ -261,10 +714,15 @@ def get_lcd_options():
             ["use_lcd",_("Enable the plugin"), "boolean", _("Enable the LCD and Button Plugin"), _("General"),datalcd['use_lcd']],
             ["enable_manual_master",_("Enable Master Mode"), "boolean", _("Enable manually starting the master station from the button and LCD menu"), _("General"),datalcd['enable_manual_master']],
             ["lcd_adress", _("i2c Address of the LCD"),"hex",_("i2c Address of the LCD"),_("LCD"),datalcd['lcd_adress']],
+            ["lcd_timing", _("LCD timing mode"),"int",_("0 = fixed delays, 1 = wait only for clear/home, 2 = read the busy flag (needs RW wired)"),_("LCD"),datalcd['lcd_timing']],
+            ["lcd_hw_scroll", _("Scroll with display shift"),"boolean",_("Scroll long lines by shifting the display instead of rewriting them"),_("LCD"),datalcd['lcd_hw_scroll']],
+            ["lcd_process", _("Run the display in its own process"),"boolean",_("Drive the LCD and the buttons from a worker process, away from the web server"),_("LCD"),datalcd['lcd_process']],
+            ["extra_displays", _("Extra displays"),"array",_("More LCDs as address@bus:colsxrows:page, separated by commas, e.g. 0x26@1:20x4:status"),_("LCD"),datalcd['extra_displays']],
             ["but1_pin", _("Button 1 PIN"),"int",_("Button 1 PIN"),_("Buttons"),datalcd['but1_pin']],
             ["but1_NormalOpen", _("Button 1 is Normal Open"),"boolean",_("Button 1 is Normal Open"),_("Buttons"),datalcd['but1_NormalOpen']],
             ["but2_pin", _("Button 2 PIN"),"int",_("Button 2 GPIO"),_("Buttons"),datalcd['but2_pin']],
-            ["but2_NormalOpen", _("Button 2 is Normal Open"),"boolean",_("Button 2 is Normal Open"),_("Buttons"),datalcd['but2_NormalOpen']]
+            ["but2_NormalOpen", _("Button 2 is Normal Open"),"boolean",_("Button 2 is Normal Open"),_("Buttons"),datalcd['but2_NormalOpen']],
+            ["but_edge_detect", _("Use GPIO edge detection"),"boolean",_("Run the buttons from GPIO edge interrupts instead of polling them"),_("Buttons"),datalcd['but_edge_detect']]
         ]
     return options
 
@@ -274,30 +732,26 @@ def notify_zone_change(name, **kw):
     pon = gv.pon
     if pon == 98:
         pgr = get_sip_status('Run-once - ')
-        message_queue.put(pgr)
+        message_queue.put(pgr, 'run-once')
+        checker.wake()
     elif pon == 99:
         pgr = get_sip_status('Manual - ')
-        message_queue.put(pgr)
+        message_queue.put(pgr, 'manual')
+        checker.wake()
     elif pon is None:
         pass
     else:
-        p = {}
-        for i in range(len(gv.ps)):
-            s = gv.ps[i]
-            if s[0] is not 0 :
-                if p.has_key(s[0]):
-                    p[s[0]][i] = 1
-                else:
-                    p[s[0]] = [0] * len(gv.scontrol.stations)
-                    p[s[0]][i] = 1
-
-        for p, s in p.items():
-            pgr = get_sip_status('Prg ' + str(p) + " - ", s)
-            message_queue.put(pgr)
+        for p in program_index.update(gv.ps): # Only the programs whose stations changed
+            s = program_index.stations(p)
+            if s:
+                pgr = get_sip_status('Prg ' + str(p) + " - ", s)
+                message_queue.put(pgr, 'prg' + str(p))
+        checker.wake()
 
 
 def notify_restart(name, **kw):
-    message_queue.put("SYSTEM IS BEING RESTARTED!!!!!!")
+    message_queue.put("SYSTEM IS BEING RESTARTED!!!!!!", 'restart', MessageQueue.HIGH)
+    checker.wake()
 
 
 zones = signal('zone_change')
@@ -311,39 +765,149 @@ restart.connect(notify_restart)
 
 
 def get_sip_status(status = "", stations = []):
-    if stations == []:
-        s = gv.scontrol.stations
+    """
+    status followed by the ranges of stations that are on, e.g. "1-3 5 ".
+    stations is a list of 0/1 (gv.scontrol.stations when empty) or a
+    bitmask with bit i set when station i + 1 is on.
+    """
+    if isinstance(stations, (int, long)):
+        runs = _mask_runs(stations)
+    else:
+        runs = _list_runs(stations or gv.scontrol.stations)
+    status += ''.join(str(first + 1) + " " if first == last else
+                      str(first + 1) + "-" + str(last + 1) + " " for first, last in runs)
+    if status == "":
+        return "Idle"
     else:
-        s = stations
+        return status
+
+
+def _list_runs(s):
+    """(first, last) index of every run of 1 in the list s."""
+    if numpy is not None:
+        on = numpy.concatenate(([False], numpy.asarray(s) == 1, [False]))
+        edges = numpy.flatnonzero(on[1:] != on[:-1]) # Starts and ends alternate
+        return zip(edges[::2].tolist(), (edges[1::2] - 1).tolist())
+    runs = []
     first_on = None
-    i = 0
-    for i in range(len(s)):
-        if s[i] == 1:
-            # This station is On!
+    for i, v in enumerate(s):
+        if v == 1:
             if first_on is None:
                 first_on = i
-        else:
-            if first_on is None:
-                continue
-            else:
-                if first_on == (i -1):
-                    status = status + str(i) + " "
-                else:
-                    status = status + str(first_on + 1 ) + "-" + str(i) + " "
-                first_on = None
-
+        elif first_on is not None:
+            runs.append((first_on, i - 1))
+            first_on = None
     if first_on is not None:
-        if first_on == (i):
-            status = status + str(i + 1) + " "
-        else:
-            status = status + str(first_on + 1 ) + "-" + str(i + 1) + " "
+        runs.append((first_on, len(s) - 1))
+    return runs
+
+
+def _mask_runs(mask):
+    """(first, last) bit of every run of set bits in mask, one step per run."""
+    runs = []
+    while mask:
+        first = (mask & -mask).bit_length() - 1
+        ones = mask >> first
+        length = (ones ^ (ones + 1)).bit_length() - 1 # Trailing set bits
+        runs.append((first, first + length - 1))
+        mask &= ~(((1 << length) - 1) << first)
+    return runs
+
+
+class ProgramIndex(object):
+    """
+    Which stations every program is running, kept as one bitmask per program
+    and updated from the changes in gv.ps only.
+    """
+
+    def __init__(self):
+        self._owner = [] # Program of every station, 0 when none
+        self._masks = {} # program -> bitmask of its stations
+        self._lock = Lock()
+
+    def update(self, ps):
+        """Catch up with ps, returns the programs whose stations changed."""
+        changed = set()
+        with self._lock:
+            owner = self._owner
+            if len(owner) < len(ps):
+                owner.extend([0] * (len(ps) - len(owner)))
+            for i in range(len(owner)):
+                p = ps[i][0] if i < len(ps) else 0
+                old = owner[i]
+                if p == old:
+                    continue
+                owner[i] = p
+                if old:
+                    self._masks[old] &= ~(1 << i)
+                    if not self._masks[old]:
+                        del self._masks[old]
+                    changed.add(old)
+                if p:
+                    self._masks[p] = self._masks.get(p, 0) | (1 << i)
+                    changed.add(p)
+            del owner[len(ps):]
+        return sorted(changed)
 
-    if status == "":
-        return "Idle"
+    def stations(self, program):
+        """Bitmask of the stations of program, 0 when it runs none."""
+        return self._masks.get(program, 0)
+
+
+program_index = ProgramIndex()
+
+
+
+################################################################################
+# Pages:                                                                       #
+################################################################################
+
+
+def _page_status():
+    return '{:^15}'.format("SIP - status"), '{:^15}'.format(get_sip_status())
+
+
+def _page_software():
+    return "Software SIP:", gv.ver_date
+
+
+def _page_ip():
+    return "My IP is:", str(providers.get('ip'))
+
+
+def _page_port():
+    return "Port IP:", "8080"
+
+
+def _page_cpu_temp():
+    return "CPU temperature:", providers.get('cpu_temp')
+
+
+def _page_date_time():
+    return time.strftime('%d.%m.%Y', time.gmtime(gv.now)), time.strftime('%H:%M:%S', time.gmtime(gv.now))
+
+
+def _page_uptime():
+    return "System run time:", providers.get('uptime')
+
+
+def _page_rain_sensor():
+    if gv.sd['rs']:
+        rain_sensor = "Active"
     else:
-        return status
+        rain_sensor = "Inactive"
+    return "Rain sensor:", rain_sensor
 
 
+register_page('status', _page_status)
+register_page('software', _page_software, None)
+register_page('ip', _page_ip, 1)
+register_page('port', _page_port, None)
+register_page('cpu_temp', _page_cpu_temp, 1)
+register_page('date_time', _page_date_time, 1)
+register_page('uptime', _page_uptime, 1)
+register_page('rain_sensor', _page_rain_sensor)
+
 
 ################################################################################
 # Web pages:                                                                   #
@@ -366,6 +930,31 @@ class settings_json(ProtectedPage):
         return json.dumps(get_lcd_options())
 
 
+class status_json(ProtectedPage):
+    """Returns a page of the status log in JSON format, newest first."""
+
+    def GET(self):
+        qdict = web.input(offset = '0', limit = '20')
+        try:
+            offset = max(0, int(qdict['offset']))
+            limit = min(max(1, int(qdict['limit'])), STATUS_ENTRIES)
+        except ValueError:
+            raise web.badrequest()
+        total, entries = checker.status_entries(offset, limit)
+        web.header('Access-Control-Allow-Origin', '*')
+        web.header('Content-Type', 'application/json')
+        return json.dumps({'total': total, 'offset': offset, 'limit': limit, 'entries': entries})
+
+
+class metrics_json(ProtectedPage):
+    """Returns the LCD and button metrics in JSON format."""
+
+    def GET(self):
+        web.header('Access-Control-Allow-Origin', '*')
+        web.header('Content-Type', 'application/json')
+        return json.dumps(checker.metrics())
+
+
 class update(ProtectedPage):
     """Save user input to lcd_button.json file."""
 
@@ -408,9 +997,8 @@ class update(ProtectedPage):
 
             r[p] = value
 
-
-        with open('./data/lcd_button.json', 'w') as f:  # write the settings to file
-            json.dump(r, f)
-
-        checker.update()
+        try:
+            config.set(r) # Saves them and tells checker what changed
+        except ValueError:
+            raise web.badrequest()
         raise web.seeother('/')
@@ -0,0 +1,478 @@
+'''
+The hardware side of the LCD-Button plugin: the LCD and the two buttons.
+LocalDisplay drives them from the calling thread, DisplayProcess from a
+worker process that gets the frames through a shared memory framebuffer
+and sends the button events back over a pipe. DisplayManager drives any
+number of extra panels with one thread per I2C bus.
+'''
+
+import mmap
+import struct
+import sys
+import time
+import traceback
+import multiprocessing
+from collections import deque
+from threading import Thread, Event, Lock
+
+import pylcd2
+import OneButton
+
+SAMPLE_PERIOD = 0.01 # Button sampler thread period
+STATS_TIME = 5 # Seconds between the stats a worker sends on its own
+
+
+class LocalDisplay(object):
+    """
+    The LCD and the buttons in this process. Button callbacks run on the
+    dispatcher thread, wake() is called whenever the buttons need poll() or
+    button 1 did something that moves last_activity().
+    """
+    LCD_KEYS = set(['lcd_adress', 'lcd_timing', 'lcd_hw_scroll'])
+
+    def __init__(self, gpio, params, port, on_click, on_chord, wake, on_error=None):
+        self._params = params
+        self._port = port
+        self._wake = wake
+        # Button callbacks run on their own thread, away from sampling and the LCD
+        self._dispatcher = OneButton.EventDispatcher()
+        self._buttons = OneButton.ButtonBank(gpio, dispatcher = self._dispatcher)
+        self._but1 = OneButton.OneButton(gpio, params['but1_pin'],
+                                         activeLow = params['but1_NormalOpen'], bank = self._buttons) # Black
+        self._but2 = OneButton.OneButton(gpio, params['but2_pin'],
+                                         activeLow = params['but2_NormalOpen'], bank = self._buttons) # Red
+        self._lcd = self._open_lcd()
+        self._but1.attachClick(on_click)
+        self._but2.attachClick(on_click)
+        for attach in (self._but1.attachDoubleClick, self._but1.attachLongPressStart,
+                       self._but1.attachLongPressStop):
+            attach(lambda pin: wake())
+        self._buttons.attachChord([self._but1, self._but2], on_chord)
+        self._edge_mode = False
+        self._sampler = None
+        self._set_edge_mode(params['but_edge_detect'])
+
+    def _open_lcd(self):
+        return pylcd2.lcd(self._params['lcd_adress'], self._port,
+                          timing = self._params['lcd_timing'],
+                          hw_scroll = self._params['lcd_hw_scroll'])
+
+    def _set_edge_mode(self, edge_mode):
+        if edge_mode:
+            if self._sampler is not None:
+                self._sampler.stop()
+                self._sampler = None
+            self._but1.enableEdgeDetect()
+            self._but2.enableEdgeDetect()
+        else:
+            if self._edge_mode:
+                self._but1.disableEdgeDetect()
+                self._but2.disableEdgeDetect()
+            # Buttons are sampled in their own thread, poll() only replays the samples
+            self._sampler = OneButton.ButtonSampler(self._buttons, SAMPLE_PERIOD, onSample = self._wake)
+            self._sampler.start()
+        self._edge_mode = edge_mode
+
+    def configure(self, params, changed):
+        """
+        Apply the changed settings, only the hardware they touch is set up
+        again. Returns True when the LCD was reopened and has to be redrawn.
+        """
+        self._params = params
+        reopened = bool(changed & self.LCD_KEYS)
+        if reopened:
+            self._lcd.close()
+            self._lcd = self._open_lcd()
+        if changed & set(['but1_pin', 'but1_NormalOpen']):
+            self._but1.setPin(params['but1_pin'], params['but1_NormalOpen'])
+        if changed & set(['but2_pin', 'but2_NormalOpen']):
+            self._but2.setPin(params['but2_pin'], params['but2_NormalOpen'])
+        if 'but_edge_detect' in changed and params['but_edge_detect'] != self._edge_mode:
+            self._set_edge_mode(params['but_edge_detect'])
+        return reopened
+
+    def lcd_puts(self, text, line):
+        self._lcd.lcd_puts(text, line)
+
+    def scroll(self):
+        self._lcd.scroll()
+
+    def next_scroll(self):
+        return self._lcd.next_scroll()
+
+    def scroll_time(self, text):
+        return self._lcd.scroll_time(text)
+
+    def poll(self):
+        """Replay the button samples, callbacks are dispatched from here."""
+        if self._sampler is not None: # Edge driven buttons need no replay
+            self._sampler.drain()
+
+    def deadline(self):
+        return self._buttons.deadline()
+
+    def last_activity(self):
+        """time.time() of the last gesture of button 1, 0 when none yet."""
+        return self._but1.lastChangeTime
+
+    def stats(self):
+        return {'i2c': self._lcd.bus_stats(),
+                'lcd_cache': self._lcd.cache_stats(),
+                'button_callbacks': self._dispatcher.stats(),
+                'button_queue': self._dispatcher.qsize(),
+                'sampler': self._sampler.stats() if not self._edge_mode else None}
+
+    def close(self):
+        if self._edge_mode:
+            self._but1.disableEdgeDetect()
+            self._but2.disableEdgeDetect()
+        elif self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+        self._dispatcher.stop()
+        self._lcd.close()
+
+
+class Framebuffer(object):
+    """
+    The lines on the display in an anonymous shared mmap, made before the
+    worker is forked. Every write bumps the frame number.
+    """
+    LINE_SIZE = 80 # Bytes kept per line, long lines are scrolled by the worker
+    _header = struct.Struct('<I')
+    _line = struct.Struct('<HB') # Length, 1 when the text was unicode
+
+    def __init__(self, lines=2):
+        self.lines = lines
+        self._lock = multiprocessing.Lock()
+        self._slot = self._line.size + self.LINE_SIZE
+        self._map = mmap.mmap(-1, self._header.size + lines * self._slot)
+
+    def write(self, texts):
+        with self._lock:
+            frame = self._header.unpack_from(self._map, 0)[0]
+            for i, text in enumerate(texts[:self.lines]):
+                is_unicode = isinstance(text, unicode)
+                data = text.encode('utf-8') if is_unicode else text
+                data = data[:self.LINE_SIZE]
+                offset = self._header.size + i * self._slot
+                self._line.pack_into(self._map, offset, len(data), is_unicode)
+                self._map[offset + self._line.size:offset + self._line.size + len(data)] = data
+            self._header.pack_into(self._map, 0, (frame + 1) & 0xFFFFFFFF)
+
+    def read(self):
+        """Returns (frame number, lines)."""
+        with self._lock:
+            frame = self._header.unpack_from(self._map, 0)[0]
+            texts = []
+            for i in range(self.lines):
+                offset = self._header.size + i * self._slot
+                length, is_unicode = self._line.unpack_from(self._map, offset)
+                data = self._map[offset + self._line.size:offset + self._line.size + length]
+                texts.append(data.decode('utf-8', 'ignore') if is_unicode else data)
+            return frame, texts
+
+
+def _worker(conn, framebuffer, gpio, params, port):
+    # Main of the display process: draws the framebuffer whenever the
+    # plugin says it changed and sends the button events back
+    send_lock = Lock()
+    inbox = deque()
+    wake = Event()
+
+    def send(*message):
+        with send_lock:
+            conn.send(message)
+
+    def receive():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, IOError): # The plugin is gone
+                message = ('stop',)
+            inbox.append(message)
+            wake.set()
+            if message[0] == 'stop':
+                return
+
+    receiver = Thread(target=receive)
+    receiver.daemon = True
+    receiver.start()
+    display = LocalDisplay(gpio, params, port, lambda pin: send('click', pin),
+                           lambda pins: send('chord', pins), wake.set)
+    shown = None
+    activity = None
+    next_stats = time.time() + STATS_TIME
+    while True:
+        try:
+            display.poll()
+            while inbox:
+                message = inbox.popleft()
+                if message[0] == 'stop':
+                    display.close()
+                    return
+                elif message[0] == 'config':
+                    if display.configure(message[1], message[2]):
+                        shown = None
+                elif message[0] == 'stats':
+                    next_stats = 0
+                # 'frame' only wakes us up
+            frame, texts = framebuffer.read()
+            if frame != shown:
+                shown = frame
+                for line, text in enumerate(texts):
+                    display.lcd_puts(text, line + 1)
+            display.scroll()
+            if display.last_activity() != activity:
+                activity = display.last_activity()
+                send('activity', activity)
+            now = time.time()
+            if now >= next_stats:
+                send('stats', display.stats())
+                next_stats = now + STATS_TIME
+            deadlines = [d for d in (display.next_scroll(), display.deadline(), next_stats) if d is not None]
+            wake.wait(max(0, min(deadlines) - time.time()))
+            wake.clear()
+        except Exception:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            send('error', ''.join(traceback.format_exception(exc_type, exc_value, exc_traceback)))
+            wake.wait(60)
+            wake.clear()
+
+
+class DisplayProcess(object):
+    """
+    Same interface as LocalDisplay with the hardware in a worker process,
+    so the I2C writes and button sampling never wait for the GIL of the web
+    server. The worker is started again if it dies.
+    """
+
+    def __init__(self, gpio, params, port, on_click, on_chord, wake, on_error=None):
+        self._gpio = gpio
+        self._params = params
+        self._port = port
+        self._on_click = on_click
+        self._on_chord = on_chord
+        self._wake = wake
+        self._on_error = on_error
+        self._framebuffer = Framebuffer()
+        self._lines = [''] * self._framebuffer.lines
+        self._dirty = True
+        self._stats = {}
+        self._activity = 0
+        self._process = None
+        self._start()
+
+    def _start(self):
+        self._conn, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_worker,
+                                                args=(child, self._framebuffer, self._gpio,
+                                                      self._params, self._port))
+        self._process.daemon = True
+        self._process.start()
+        child.close()
+        receiver = Thread(target=self._receive, args=(self._conn, self._process))
+        receiver.daemon = True
+        receiver.start()
+        self._dirty = True # The new worker has to be woken up for the frame
+
+    def _receive(self, conn, process):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, IOError): # Worker gone, have poll() start another
+                process.join(1) # The pipe closes before it can be reaped
+                self._wake()
+                return
+            if message[0] == 'click':
+                self._on_click(message[1])
+            elif message[0] == 'chord':
+                self._on_chord(message[1])
+            elif message[0] == 'stats':
+                self._stats = message[1]
+            elif message[0] == 'activity':
+                self._activity = max(self._activity, message[1]) # A new worker starts at 0
+            elif message[0] == 'error' and self._on_error:
+                self._on_error(message[1])
+
+    def _send(self, *message):
+        try:
+            self._conn.send(message)
+        except (EOFError, IOError):
+            pass # Worker gone, poll() starts another
+
+    def configure(self, params, changed):
+        self._params = params
+        self._send('config', params, changed)
+        return False # The worker redraws the framebuffer itself
+
+    def lcd_puts(self, text, line):
+        if self._lines[line - 1] != text:
+            self._lines[line - 1] = text
+            self._dirty = True
+
+    def scroll(self):
+        # Called once per loop, publish the lines written since the last one
+        if self._dirty:
+            self._dirty = False
+            self._framebuffer.write(self._lines)
+            self._send('frame')
+
+    def next_scroll(self):
+        return None # The worker scrolls on its own
+
+    def scroll_time(self, text):
+        return max(0, len(text) - pylcd2.lcd.LCD_WIDTH) * pylcd2.lcd.SCROLL_DELAY
+
+    def poll(self):
+        if not self._process.is_alive():
+            if self._on_error:
+                self._on_error('LCD worker exited with code %s, starting it again' % self._process.exitcode)
+            self._start()
+
+    def deadline(self):
+        return None # Button timeouts are the worker's
+
+    def last_activity(self):
+        return self._activity
+
+    def stats(self):
+        self._send('stats') # Fresh figures for the next call
+        stats = dict(self._stats)
+        stats['worker_pid'] = self._process.pid
+        return stats
+
+    def close(self):
+        self._send('stop')
+        self._process.join(2)
+        if self._process.is_alive(): # Hung, it would keep the bus and the pins
+            self._process.terminate()
+            self._process.join(1)
+
+
+def parse_panels(entries, port):
+    """
+    Extra panels from entries like '0x26@1:20x4:status' (address, optional
+    bus port, optional geometry and optional page), as dicts with addr,
+    port, cols, rows and page. Raises ValueError on a malformed entry.
+    """
+    panels = []
+    for entry in entries:
+        parts = str(entry).strip().split(':')
+        if not parts[0]:
+            continue
+        addr, _, bus = parts[0].partition('@')
+        panel = {'addr': int(addr, 0), 'port': int(bus) if bus else port,
+                 'cols': pylcd2.lcd.LCD_WIDTH, 'rows': pylcd2.lcd.LCD_LINES, 'page': 'status'}
+        for part in parts[1:]:
+            cols, x, rows = part.lower().partition('x')
+            if x and cols.isdigit() and rows.isdigit():
+                panel['cols'], panel['rows'] = int(cols), int(rows)
+            elif part:
+                panel['page'] = part
+        if not 0x03 <= panel['addr'] <= 0x77 or not 1 <= panel['rows'] <= 4 or \
+                not 8 <= panel['cols'] <= 40 or panel['cols'] * ((panel['rows'] + 1) // 2) > 40:
+            raise ValueError('Bad display ' + str(entry))
+        panels.append(panel)
+    return panels
+
+
+class BusWorker(Thread):
+    """
+    Draws the panels of one I2C bus, the panels of different buses are drawn
+    in parallel. Only the latest frame of each panel is kept, and a panel is
+    opened in this thread on its first frame so a missing one only costs
+    its own bus.
+    """
+
+    def __init__(self, port, timing, hw_scroll):
+        Thread.__init__(self)
+        self.daemon = True
+        self.port = port
+        self._timing = timing
+        self._hw_scroll = hw_scroll
+        self._specs = {} # key -> panel dict from parse_panels
+        self._panels = {} # key -> open pylcd2.lcd
+        self._pending = {} # key -> lines waiting to be drawn
+        self._lock = Lock()
+        self._wake = Event()
+        self._stopped = False
+        self.frames = 0
+        self.errors = 0
+        self.last_error = None
+
+    def add(self, key, spec):
+        with self._lock:
+            self._specs[key] = spec
+
+    def show(self, key, lines):
+        with self._lock:
+            self._pending[key] = lines
+        self._wake.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def _open(self, key):
+        spec = self._specs[key]
+        panel = pylcd2.lcd(spec['addr'], self.port, timing = self._timing, hw_scroll = self._hw_scroll,
+                           cols = spec['cols'], rows = spec['rows'])
+        self._panels[key] = panel
+        return panel
+
+    def run(self):
+        while not self._stopped:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for key, lines in pending.items():
+                try:
+                    panel = self._panels.get(key) or self._open(key)
+                    for row in range(panel.rows):
+                        panel.lcd_puts(lines[row] if row < len(lines) else '', row + 1)
+                    self.frames += 1
+                except Exception as e: # Try again with the next frame
+                    panel = self._panels.pop(key, None)
+                    if panel is not None:
+                        panel.close()
+                    self.errors += 1
+                    self.last_error = '%s: %s' % (self._specs[key]['addr'], e)
+            for panel in self._panels.values():
+                panel.scroll()
+            steps = [d for d in (panel.next_scroll() for panel in self._panels.values()) if d is not None]
+            self._wake.wait(max(0, min(steps) - time.time()) if steps else None)
+            self._wake.clear()
+        for panel in self._panels.values():
+            panel.close()
+
+    def stats(self):
+        return {'frames': self.frames, 'errors': self.errors, 'last_error': self.last_error,
+                'panels': dict((str(key), panel.bus_stats()) for key, panel in self._panels.items())}
+
+
+class DisplayManager(object):
+    """Extra panels on any number of buses, with one BusWorker per bus."""
+
+    def __init__(self, timing=pylcd2.lcd.TIMING_ADAPTIVE, hw_scroll=False):
+        self._timing = timing
+        self._hw_scroll = hw_scroll
+        self._workers = {} # port -> BusWorker
+        self._panels = {} # key -> BusWorker of its bus
+
+    def add(self, key, spec):
+        worker = self._workers.get(spec['port'])
+        if worker is None:
+            worker = self._workers[spec['port']] = BusWorker(spec['port'], self._timing, self._hw_scroll)
+            worker.start()
+        worker.add(key, spec)
+        self._panels[key] = worker
+
+    def show(self, key, lines):
+        self._panels[key].show(key, lines)
+
+    def stats(self):
+        return dict((str(port), worker.stats()) for port, worker in self._workers.items())
+
+    def close(self):
+        for worker in self._workers.values():
+            worker.stop()
@@ -1,23 +1,465 @@
 '''
 '''
 
-import smbus
+try:
+    import smbus
+except ImportError: # Off the board pass a bus, e.g. simulate.SMBus()
+    smbus = None
+import os
 import time
+import unicodedata
+from collections import deque, OrderedDict
+from threading import Thread, Condition, Event, Lock
+
+# One bus handle per port shared by all the devices on it
+_buses = {}
+_schedulers = {}
+_buses_lock = Lock()
+
+def shared_bus(port):
+    # A forked process opens its own, the slave address is per open file
+    key = (os.getpid(), port)
+    with _buses_lock:
+        if key not in _buses:
+            if smbus is None:
+                raise ImportError('smbus is not installed, pass a bus')
+            _buses[key] = smbus.SMBus(port)
+        return _buses[key]
+
+def bus_scheduler(bus):
+    # The scheduler of bus, other plugins on the same bus should use it too
+    key = (os.getpid(), id(bus))
+    with _buses_lock:
+        if key not in _schedulers:
+            _schedulers[key] = i2c_scheduler(bus) # Holds bus, so its id is not reused
+        return _schedulers[key]
+
+
+class i2c_scheduler(Thread):
+    '''
+    Runs every transaction on one bus from a single thread, a transaction
+    being a function of the bus that runs as a whole. The lowest priority
+    number goes first, owners with the same priority take turns, and a
+    waiting transaction gains one level every AGING seconds so nothing
+    starves. An owner's transactions always run in the order they came.
+    Display writes queued with post() are merged into one transaction.
+    '''
+    PRIORITY_CONTROL = 0 # Relays and outputs
+    PRIORITY_SENSOR = 1
+    PRIORITY_DISPLAY = 2
+    AGING = 0.5
+
+    def __init__(self, bus):
+        Thread.__init__(self)
+        self.daemon = True
+        self.bus = bus
+        self._cond = Condition(Lock())
+        self._queues = {} # owner -> deque of [func, priority, time queued, done, result]
+        self._failures = {} # owner -> error of its last failed post()
+        self._turns = deque() # Owners with work, the next one to serve first
+        self._since = time.time()
+        self._busy = 0.0
+        self.transactions = 0
+        self.merged = 0
+        self.errors = 0
+        self.last_error = None
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self.start()
+
+    def transaction(self, func, priority=PRIORITY_CONTROL, owner=None):
+        '''Run func(bus) on the bus and return what it returns'''
+        item = [func, priority, time.time(), Event(), None]
+        self._put(owner, item)
+        item[3].wait()
+        failed, result = item[4]
+        if failed:
+            raise result
+        return result
+
+    def post(self, addr, data, priority=PRIORITY_DISPLAY, owner=None):
+        '''
+        Queue bytes for addr without waiting, merged with the owner's next
+        ones. When they fail the error is kept for failure(owner).
+        '''
+        self._put(owner, [(addr, list(data)), priority, time.time(), None, owner])
+
+    def failure(self, owner):
+        '''The error of the owner's last failed post() since asked, or None'''
+        with self._cond:
+            return self._failures.pop(owner, None)
+
+    def _put(self, owner, item):
+        with self._cond:
+            queue = self._queues.get(owner)
+            if queue is None:
+                queue = self._queues[owner] = deque()
+            if not queue:
+                self._turns.append(owner)
+            elif item[3] is None and queue[-1][3] is None and queue[-1][0][0] == item[0][0]:
+                queue[-1][0][1].extend(item[0][1]) # Batch with the write still waiting
+                self.merged += 1
+                return
+            queue.append(item)
+            self._cond.notify()
+
+    def _next(self):
+        # Head of the owner to serve, by aged priority then by turn
+        now = time.time()
+        best = None
+        for n, owner in enumerate(self._turns):
+            head = self._queues[owner][0]
+            rank = head[1] - (now - head[2]) / self.AGING
+            if best is None or rank < best[0]:
+                best = (rank, n, owner)
+        owner = best[2]
+        del self._turns[best[1]]
+        queue = self._queues[owner]
+        item = queue.popleft()
+        if queue:
+            self._turns.append(owner) # Back of the line
+        else:
+            del self._queues[owner] # Keep nothing of owners that are done
+        return item
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._turns:
+                    self._cond.wait()
+                item = self._next()
+            func, priority, queued, done = item[:4]
+            start = time.time()
+            wait = start - queued
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            try:
+                if done is None:
+                    result = (False, i2c_device.write_chunks(self.bus, func[0], func[1]))
+                else:
+                    result = (False, func(self.bus))
+            except Exception as e:
+                result = (True, e)
+                self.errors += 1
+                self.last_error = repr(e)
+                if done is None:
+                    with self._cond:
+                        self._failures[item[4]] = e
+            self._busy += time.time() - start
+            self.transactions += 1
+            if done is not None:
+                item[4] = result
+                done.set()
+
+    def stats(self):
+        elapsed = max(time.time() - self._since, 1e-6)
+        return {'utilisation': self._busy / elapsed, 'transactions': self.transactions,
+                'merged': self.merged, 'errors': self.errors, 'last_error': self.last_error,
+                'wait_avg': self._wait_total / self.transactions if self.transactions else 0.0,
+                'wait_max': self._wait_max}
+
 
 # General i2c device class so that other devices can be added easily
 class i2c_device:
-    def __init__(self, addr, port):
+    BLOCK_SIZE = 32 # SMBus limit for the data part of a block write
+
+    def __init__(self, addr, port, bus=None, priority=i2c_scheduler.PRIORITY_DISPLAY):
         self.addr = addr
-        self.bus = smbus.SMBus(port)
+        self.bus = bus if bus is not None else shared_bus(port)
+        self.scheduler = bus_scheduler(self.bus)
+        self.priority = priority
+        # Traffic counters, plain adds cheap enough to always keep
+        self.transactions = 0
+        self.bytes = 0
+        self.since = time.time()
+
+    def _run(self, func):
+        result = self.scheduler.transaction(func, self.priority, self)
+        self._check()
+        return result
+
+    def _check(self):
+        # Raise the error of a write queued without wait
+        error = self.scheduler.failure(self)
+        if error is not None:
+            raise error
 
     def write(self, byte):
-        self.bus.write_byte(self.addr, byte)
+        self.transactions += 1
+        self.bytes += 1
+        self._run(lambda bus: bus.write_byte(self.addr, byte))
+
+    @staticmethod
+    def write_chunks(bus, addr, data):
+        # The first byte of each chunk goes out as the "command" byte, a plain
+        # output expander like the PCF8574 latches it like any other byte.
+        for i in range(0, len(data), i2c_device.BLOCK_SIZE + 1):
+            chunk = data[i:i + i2c_device.BLOCK_SIZE + 1]
+            if len(chunk) == 1:
+                bus.write_byte(addr, chunk[0])
+            else:
+                bus.write_i2c_block_data(addr, chunk[0], list(chunk[1:]))
+
+    def write_block(self, data, wait=True): # For sequential writes > 1 byte
+        # Without wait the bytes are queued, to go out when the bus is free
+        self.transactions += (len(data) + self.BLOCK_SIZE) // (self.BLOCK_SIZE + 1)
+        self.bytes += len(data)
+        if wait:
+            self._run(lambda bus: self.write_chunks(bus, self.addr, data))
+        else:
+            self._check()
+            self.scheduler.post(self.addr, data, self.priority, self)
 
     def read(self):
-        return self.bus.read_byte(self.addr)
+        self.transactions += 1
+        self.bytes += 1
+        return self._run(lambda bus: bus.read_byte(self.addr))
 
     def read_nbytes_data(self, data, n): # For sequential reads > 1 byte
-        return self.bus.read_i2c_block_data(self.addr, data, n)
+        self.transactions += 1
+        self.bytes += n + 1
+        return self._run(lambda bus: bus.read_i2c_block_data(self.addr, data, n))
+
+    def sync(self):
+        # Wait until the writes queued without wait are on the bus
+        self._run(lambda bus: None)
+
+    def close(self):
+        # Wait for the queued writes and drop their error, so the scheduler
+        # holds nothing of the device
+        self.scheduler.transaction(lambda bus: None, self.priority, self)
+        self.scheduler.failure(self)
+
+    def stats(self):
+        # Totals and per second rates since the device was opened
+        elapsed = max(time.time() - self.since, 1e-6)
+        return {'transactions': self.transactions, 'bytes': self.bytes, 'seconds': elapsed,
+                'transactions_per_s': self.transactions / elapsed, 'bytes_per_s': self.bytes / elapsed,
+                'bus': self.scheduler.stats()}
+
+
+class marquee:
+    '''
+    Scroll state of a line longer than the display, advanced by lcd.scroll()
+    '''
+    GAP = 4 # Blank cells between the end of the text and its start again
+
+    def __init__(self, text, width, delay, offset=0):
+        self.text = text
+        self._loop = text + ' ' * self.GAP
+        self._width = width
+        self._delay = delay
+        self._offset = offset % len(self._loop)
+        self.next_step = time.time() + delay
+
+    def window(self):
+        return (self._loop + self._loop)[self._offset:self._offset + self._width]
+
+    def step(self, now):
+        if now < self.next_step:
+            return False
+        self._offset = (self._offset + 1) % len(self._loop)
+        self.next_step = max(self.next_step + self._delay, now)
+        return True
+
+
+class lru:
+    '''
+    Dictionary keeping only the size most recently used entries
+    '''
+
+    def __init__(self, size):
+        self._size = size
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self._items.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items[key] = value # Most recent last
+        return value
+
+    def put(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self._size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self):
+        return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+
+class charset:
+    '''
+    Unicode to the codes of the HD44780 A00 character ROM, the common one.
+    ASCII is the same except backslash and tilde. Characters the ROM lacks
+    use a custom glyph when one is defined for them, else lose their
+    accents (a missing accented capital shows its plain letter), else
+    show as '?'. Text in str is taken as UTF-8.
+    '''
+    ROM = {u'\xa5': 0x5C, # Yen
+           u'\u2192': 0x7E, u'\u2190': 0x7F, # Right and left arrows
+           u'\xb0': 0xDF, # Degree
+           u'\u03b1': 0xE0, u'\xe4': 0xE1, u'\xdf': 0xE2, u'\u03b2': 0xE2, u'\u03b5': 0xE3,
+           u'\xb5': 0xE4, u'\u03bc': 0xE4, u'\u03c3': 0xE5, u'\u03c1': 0xE6, u'\u221a': 0xE8,
+           u'\xa2': 0xEC, u'\xf1': 0xEE, u'\xf6': 0xEF, u'\u03b8': 0xF2, u'\u221e': 0xF3,
+           u'\u03a9': 0xF4, u'\xfc': 0xF5, u'\u03a3': 0xF6, u'\u03c0': 0xF7, u'\xf7': 0xFD,
+           u'\u2588': 0xFF}
+    FALLBACK = {u'\\': u'/', u'~': u'-', u'\xbf': u'?', u'\xa1': u'!', u'\xab': u'<', u'\xbb': u'>',
+                u'\u2013': u'-', u'\u2014': u'-', u'\u2018': u"'", u'\u2019': u"'",
+                u'\u201c': u'"', u'\u201d': u'"', u'\xb7': u'.'}
+    CACHE_SIZE = 64
+
+    def __init__(self):
+        self._rom = dict((c, unichr(c)) for c in range(0x20, 0x7E) if c != 0x5C)
+        self._rom.update((ord(ch), unichr(code)) for ch, code in self.ROM.items())
+        self.glyphs = {} # Character -> CGRAM code, 0 to 7
+        self._table = dict(self._rom)
+        self._cache = lru(self.CACHE_SIZE)
+
+    def define(self, char, code):
+        '''Show char with the custom glyph code, None to stop'''
+        if code is None:
+            self.glyphs.pop(char, None)
+        else:
+            self.glyphs[char] = code
+        self._table = dict(self._rom)
+        self._cache.clear()
+
+    def encode(self, text):
+        '''Tuple of the display codes of text'''
+        codes = self._cache.get(text)
+        if codes is None:
+            key = text
+            if isinstance(text, str):
+                text = text.decode('utf-8', 'replace')
+            table = self._table
+            for ch in set(text):
+                if ord(ch) not in table:
+                    table[ord(ch)] = unichr(self._resolve(ch))
+            # Every code fits in a latin-1 character, so this stays in C
+            codes = tuple(bytearray(text.translate(table).encode('latin-1')))
+            self._cache.put(key, codes)
+        return codes
+
+    def _resolve(self, ch):
+        # Code for a character outside the table
+        if ch in self.glyphs:
+            return self.glyphs[ch]
+        if ch in self.FALLBACK:
+            return ord(self._table[ord(self.FALLBACK[ch])])
+        if unicodedata.category(ch) == 'Cc':
+            return 0x20
+        base = u''.join(c for c in unicodedata.normalize('NFKD', ch) if not unicodedata.combining(c))
+        if len(base) == 1 and base != ch:
+            if base in self.glyphs:
+                return self.glyphs[base]
+            if ord(base) in self._rom:
+                return ord(self._rom[ord(base)])
+        return ord('?')
+
+
+# Icons for the custom character slots, put their character in the text to
+# show them. Each is 8 rows of 5 pixels, top row first.
+ICON_PUMP = u'\ue000'
+ICON_RAIN = u'\ue001'
+ICON_WIFI = u'\ue002'
+ICON_BARS = (u'\ue010', u'\ue011', u'\ue012', u'\ue013') # 1 to 4 columns of a cell
+FULL_BLOCK = u'\u2588' # In the ROM, needs no slot
+ICONS = {ICON_PUMP: [0b00100, 0b00100, 0b01110, 0b01110, 0b11111, 0b11111, 0b01110, 0b00000],
+         ICON_RAIN: [0b01100, 0b11110, 0b11111, 0b00000, 0b01010, 0b10100, 0b01010, 0b00000],
+         ICON_WIFI: [0b00000, 0b01110, 0b10001, 0b00100, 0b01010, 0b00000, 0b00100, 0b00000]}
+for columns, char in enumerate(ICON_BARS):
+    ICONS[char] = [(0b11111 << (4 - columns)) & 0b11111] * 8
+
+def bar_graph(fraction, width):
+    # Text of width cells filled to fraction in fifths of a cell, at most
+    # one partial cell so a bar needs one slot
+    steps = int(round(max(0.0, min(1.0, fraction)) * width * 5))
+    full, part = divmod(steps, 5)
+    text = FULL_BLOCK * full + (ICON_BARS[part - 1] if part else u'')
+    return text.ljust(width)
+
+
+class glyph_slots:
+    '''
+    Which custom glyph is in which of the 8 CGRAM slots of a display.
+    Glyphs load when text uses them, a glyph already in a slot is not sent
+    again. When all slots are taken the least recently used glyph that is
+    not on the display makes room; with none free the character shows as
+    charset shows characters it has no glyph for.
+    '''
+    SLOTS = 8
+
+    def __init__(self, charset):
+        self.bitmaps = dict(ICONS) # Character -> rows
+        self._charset = charset
+        self._slots = OrderedDict() # Character -> slot, least recently used first
+        self.uploads = 0
+        self.evictions = 0
+        self.full = 0
+
+    def define(self, char, rows):
+        '''Add or change a glyph, returns its slot when it has to be sent again'''
+        self.bitmaps[char] = list(rows)
+        return self._slots.get(char)
+
+    def load(self, text, in_use):
+        '''
+        Put the glyphs text uses in slots, returns the (slot, rows) to send.
+        in_use() gives the codes on the display or waiting to be.
+        '''
+        chars = set(text).intersection(self.bitmaps)
+        missing = []
+        for char in chars:
+            if char in self._slots:
+                self._slots[char] = self._slots.pop(char) # Most recent last
+            else:
+                missing.append(char)
+        uploads = []
+        if missing:
+            # The slots text already has are in use too
+            used = in_use() | set(self._slots[char] for char in chars if char in self._slots)
+            for char in missing:
+                slot = self._free(used)
+                if slot is None:
+                    self.full += 1
+                    continue
+                used.add(slot)
+                self._slots[char] = slot
+                self._charset.define(char, slot)
+                uploads.append((slot, self.bitmaps[char]))
+                self.uploads += 1
+        return uploads
+
+    def _free(self, used):
+        # A slot nobody has, else the one of the oldest glyph off the display
+        taken = set(self._slots.values())
+        for slot in range(self.SLOTS):
+            if slot not in taken:
+                return slot
+        for char, slot in self._slots.items():
+            if slot not in used:
+                del self._slots[char]
+                self._charset.define(char, None)
+                self.evictions += 1
+                return slot
+        return None
+
+    def resident(self):
+        '''(slot, rows) of every glyph in a slot'''
+        return [(slot, self.bitmaps[char]) for char, slot in self._slots.items()]
+
+    def stats(self):
+        return {'resident': len(self._slots), 'uploads': self.uploads,
+                'evictions': self.evictions, 'full': self.full}
 
 
 class lcd:
@@ -29,32 +471,200 @@ class lcd:
         http://www.dx.com/es/p/i2c-iic-lcd-1602-display-module-with-white-backlight-4-pin-cable-for-arduino-raspberry-pi-374741
     '''
     # Some Constants
-    LCD_WIDTH = 16
+    LCD_WIDTH = 16 # Default geometry, see cols and rows
+    LCD_LINES = 2
+    DDRAM_WIDTH = 40 # Characters per line held by the controller
     LCD_CHR = 1 # Mode - Sending data
     LCD_CMD = 0 # Mode - Sending command
 
-    LCD_LINE_ADDR = [0x80, 0xC0, 0x94, 0xD4] # LCD RAM address for each line
+    LCD_LINE_ADDR = [0x80, 0xC0, 0x94, 0xD4] # LCD RAM address for each line of a 20x4
+    LCD_SHIFT_LEFT = 0x18 # Move the visible window one cell to the right of DDRAM
 
     LCD_BACKLIGHT  = 0x08  # On
     #LCD_BACKLIGHT = 0x00  # Off
     ENABLE = 0b00000100 # Enable bit
+    LCD_RW = 0b00000010 # Read/Write bit
 
     # Timing constants
     E_PULSE = 0.0005
     E_DELAY = 0.0005
+    HOME_DELAY = 0.002    # Clear and home take 1.52ms, everything else 37us
+    BUSY_TIMEOUT = 0.01
+    SCROLL_DELAY = 0.3    # Seconds per scroll step
+    LINE_CACHE = 32       # Encoded row updates kept, see _put_row()
 
-    def __init__(self, addr, port):
-        self._bus = i2c_device(addr, port)
+    # Timing modes
+    TIMING_FIXED = 0      # E_PULSE/E_DELAY around every nibble
+    TIMING_ADAPTIVE = 1   # Wait only after clear and home
+    TIMING_BUSY = 2       # Poll the busy flag after each command
+
+    def __init__(self, addr, port, timing=TIMING_FIXED, hw_scroll=False, bus=None,
+                 cols=LCD_WIDTH, rows=LCD_LINES):
+        self._bus = i2c_device(addr, port, bus)
         self.i2c_address = addr
+        self.cols = cols
+        self.rows = rows
+        # Lines 3 and 4 are the second halves of the two DDRAM lines, so
+        # shifting the display would move them too
+        self._hw_scroll = hw_scroll and rows <= 2
+        self._marquee = {}
+        self._hw_lines = {}
+        self._hw_origin = {} # line -> _shift when it was loaded
+        self._hw_next_step = 0
+        self.charset = charset()
+        self.glyphs = glyph_slots(self.charset)
+        self._glyphs_lost = False
+        self._lines = lru(self.LINE_CACHE)
 
-        # Initialise display
-        self._lcd_byte(0x33,self.LCD_CMD) # 110011 Initialise
-        self._lcd_byte(0x32,self.LCD_CMD) # 110010 Initialise
-        self._lcd_byte(0x06,self.LCD_CMD) # 000110 Cursor move direction
-        self._lcd_byte(0x0C,self.LCD_CMD) # 001100 Display On,Cursor Off, Blink Off
-        self._lcd_byte(0x28,self.LCD_CMD) # 101000 Data length, number of lines, font size
-        self._lcd_byte(0x01,self.LCD_CMD) # 000001 Clear display
+        # Initialise display, always with the conservative delays
+        self._timing = self.TIMING_FIXED
+        try:
+            self._lcd_byte(0x33,self.LCD_CMD) # 110011 Initialise
+            self._lcd_byte(0x32,self.LCD_CMD) # 110010 Initialise
+            self._lcd_byte(0x06,self.LCD_CMD) # 000110 Cursor move direction
+            self._lcd_byte(0x0C,self.LCD_CMD) # 001100 Display On,Cursor Off, Blink Off
+            self._lcd_byte(0x28,self.LCD_CMD) # 101000 Data length, number of lines, font size
+            self._lcd_byte(0x01,self.LCD_CMD) # 000001 Clear display
+        except Exception:
+            self._bus.close()
+            raise
         time.sleep(self.E_DELAY)
+        self._reset_shadow()
+        self._timing = timing
+
+    def bus_stats(self):
+        return self._bus.stats()
+
+    # let go of the bus, after the queued writes
+    def close(self):
+        self._bus.close()
+
+    def cache_stats(self):
+        return {'text': self.charset._cache.stats(), 'lines': self._lines.stats(),
+                'glyphs': self.glyphs.stats()}
+
+    # add or change a custom glyph, shown wherever char is in the text
+    def define_glyph(self, char, rows):
+        slot = self.glyphs.define(char, rows)
+        if slot is not None:
+            self._upload_glyphs([(slot, rows)])
+
+    # make the glyphs text uses resident before it is encoded
+    def _load_glyphs(self, text):
+        uploads = self.glyphs.load(text, self._codes_in_use)
+        if uploads:
+            self._upload_glyphs(uploads)
+
+    def _upload_glyphs(self, uploads):
+        self._post(self._glyph_data(uploads))
+
+    def _glyph_data(self, uploads):
+        data = []
+        for slot, rows in uploads:
+            data.extend(self._lcd_encode(0x40 | slot << 3, self.LCD_CMD)) # Set CGRAM address
+            for bits in rows:
+                data.extend(self._lcd_encode(bits, self.LCD_CHR))
+        self._cursor = None # The address counter is in CGRAM now
+        return data
+
+    # codes on the display or in the frame waiting for flush()
+    def _codes_in_use(self):
+        used = set()
+        for cells in self._shadow + self._frame:
+            used.update(cells)
+        return used
+
+    # wait for the queued display writes to reach the display
+    def sync(self):
+        try:
+            self._bus.sync()
+        except Exception:
+            self._lost()
+            raise
+
+    # queue bytes for the display. When an earlier queued write failed the
+    # display may not show what the shadow says, so the error is raised and
+    # the next frame is drawn in full, with the glyphs sent again.
+    # In fixed timing every nibble goes out on its own with the E sleeps.
+    def _post(self, data):
+        if self._glyphs_lost:
+            data = self._glyph_data(self.glyphs.resident()) + data
+            self._glyphs_lost = False
+        try:
+            if self._timing == self.TIMING_FIXED:
+                for i in range(0, len(data), 3): # Nibble, then its strobe, see _lcd_encode()
+                    self._bus.write(data[i])
+                    self._lcd_toggle_enable(data[i])
+            else:
+                self._bus.write_block(data, wait=False)
+        except Exception:
+            self._lost()
+            raise
+
+    def _lost(self):
+        self._shadow = [[-1] * self.DDRAM_WIDTH for i in range(2)] # Matches no code
+        self._cursor = None
+        self._hw_lines = {}
+        self._glyphs_lost = bool(self.glyphs.resident())
+
+    def _reset_shadow(self):
+        # Shadow copy of the display RAM and the frame waiting for flush()
+        # A cleared display holds spaces, unshifted, with the cursor at home
+        self._shadow = [[0x20] * self.DDRAM_WIDTH for i in range(2)]
+        self._frame = [(0x20,) * self.cols for i in range(self.rows)]
+        self._cursor = (0, 0)
+        self._shift = 0
+
+    def _visible(self, row, cells):
+        # Pair the cells of a visible row with the DDRAM index they show at,
+        # rows 3 and 4 start cols cells into DDRAM lines 1 and 2
+        start = self._shift + (row // 2) * self.cols
+        return [((start + col) % self.DDRAM_WIDTH, code) for col, code in enumerate(cells)]
+
+    def _put_cells(self, row, cells, data, force=False):
+        # Encode (DDRAM index, code) pairs that differ from the shadow into data,
+        # with an address command only where the cursor is not already there
+        line = row % 2
+        shadow = self._shadow[line]
+        for idx, code in cells:
+            if shadow[idx] == code and not force:
+                continue
+            if self._cursor != (line, idx):
+                data.extend(self._lcd_encode(self.LCD_LINE_ADDR[line] + idx, self.LCD_CMD))
+            data.extend(self._lcd_encode(code, self.LCD_CHR))
+            shadow[idx] = code
+            self._cursor = (line, idx + 1)
+
+    def _put_row(self, row, cells, data, force=False):
+        # _put_cells for a whole visible row. The same change made from the
+        # same cursor always encodes to the same bytes, so a page shown again
+        # or a label redrawn costs a lookup instead of work per cell.
+        line = row % 2
+        start = (self._shift + (row // 2) * self.cols) % self.DDRAM_WIDTH
+        end = start + len(cells)
+        shadow = self._shadow[line]
+        if end <= self.DDRAM_WIDTH:
+            old = tuple(shadow[start:end])
+        else:
+            old = tuple(shadow[start:] + shadow[:end - self.DDRAM_WIDTH])
+        if old == cells and not force:
+            return
+        key = (line, start, self._cursor, None if force else old, cells)
+        hit = self._lines.get(key)
+        if hit is None:
+            encoded = []
+            self._put_cells(row, self._visible(row, cells), encoded, force)
+            self._lines.put(key, (encoded, self._cursor))
+            data.extend(encoded)
+            return
+        data.extend(hit[0])
+        self._cursor = hit[1]
+        if end <= self.DDRAM_WIDTH:
+            shadow[start:end] = cells
+        else:
+            split = self.DDRAM_WIDTH - start
+            shadow[start:] = cells[:split]
+            shadow[:end - self.DDRAM_WIDTH] = cells[split:]
 
     def _lcd_byte(self, bits, mode):
         # Send byte to data pins
@@ -62,6 +672,12 @@ class lcd:
         # mode = 1 for data
         #        0 for command
 
+        if self._timing != self.TIMING_FIXED:
+            self._bus.write_block(self._lcd_encode(bits, mode))
+            if mode == self.LCD_CMD:
+                self._lcd_wait(bits)
+            return
+
         bits_high = mode | (bits & 0xF0) | self.LCD_BACKLIGHT
         bits_low = mode | ((bits<<4) & 0xF0) | self.LCD_BACKLIGHT
 
@@ -73,6 +689,40 @@ class lcd:
         self._bus.write(bits_low)
         self._lcd_toggle_enable(bits_low)
 
+    def _lcd_wait(self, cmd):
+        # Writing the next byte takes longer than the 37us most commands need,
+        # only clear and home have to be waited for.
+        if self._timing == self.TIMING_BUSY:
+            self._lcd_wait_busy()
+        elif cmd < 0x04:
+            time.sleep(self.HOME_DELAY)
+
+    def _lcd_wait_busy(self):
+        # The busy flag is D7: data pins high so the PCF8574 lets the LCD drive
+        # them, RW high, RS low. Each read takes two strobes in 4 bit mode.
+        bits = 0xF0 | self.LCD_RW | self.LCD_BACKLIGHT
+        deadline = time.time() + self.BUSY_TIMEOUT
+        while True:
+            self._bus.write_block([bits, bits | self.ENABLE])
+            busy = self._bus.read() & 0x80
+            self._bus.write_block([bits, bits | self.ENABLE, bits])
+            if not busy:
+                return
+            if time.time() > deadline:
+                # RW not wired or the read is unreliable, stop polling
+                self._timing = self.TIMING_ADAPTIVE
+                time.sleep(self.HOME_DELAY)
+                return
+
+    def _lcd_encode(self, bits, mode):
+        # Bytes to put on the expander for one byte, with its enable strobes.
+        # One bus byte takes longer than the enable pulse and the execution
+        # time of data writes, so no sleeps are needed between them.
+        bits_high = mode | (bits & 0xF0) | self.LCD_BACKLIGHT
+        bits_low = mode | ((bits<<4) & 0xF0) | self.LCD_BACKLIGHT
+        return [bits_high, bits_high | self.ENABLE, bits_high,
+                bits_low, bits_low | self.ENABLE, bits_low]
+
     def _lcd_toggle_enable(self, bits):
           # Toggle enable
         time.sleep(self.E_DELAY)
@@ -83,31 +733,146 @@ class lcd:
 
     def lcd_string(self, message,line):
       # Send string to display
-        line = self.LCD_LINE_ADDR[(line - 1)]
+        row = line - 1
+
+        message = self._text(message)[:self.cols].ljust(self.cols," ")
+        self._marquee.pop(line, None)
+        self._hw_lines.pop(line, None)
+        if message.strip() and self._hw_stop():
+            self.flush() # The other lines, before this one is written over
+        self._load_glyphs(message)
+        cells = self.charset.encode(message)
+
+        data = []
+        self._put_row(row, cells, data, force=True)
+        self._post(data)
+        self._frame[row] = cells
 
-        message = message.ljust(self.LCD_WIDTH," ")
+    # put string in the frame buffer, sent to the display on flush()
+    def set_line(self, message, line):
+        message = self._text(message)[:self.cols].ljust(self.cols," ")
+        self._load_glyphs(message)
+        self._frame[line - 1] = self.charset.encode(message)
 
-        self._lcd_byte(line, self.LCD_CMD)
+    # send only the cells that differ from what the display already shows
+    def flush(self):
+        data = []
+        for row in range(self.rows):
+            if (row + 1) not in self._hw_lines: # Shifting lines live in DDRAM
+                self._put_row(row, self._frame[row], data)
+        if data:
+            self._post(data)
 
-        for i in range(self.LCD_WIDTH):
-            self._lcd_byte(ord(message[i]),self.LCD_CHR)
+    # load a whole line into DDRAM, starting at the visible window, and let
+    # scroll() move the window with shift commands
+    def _hw_load(self, string, line):
+        row = line - 1
+        self._load_glyphs(string)
+        cells = self.charset.encode(string.ljust(self.DDRAM_WIDTH, " "))
+        data = []
+        self._put_cells(row, self._visible(row, cells), data)
+        if data:
+            self._post(data)
+        self._frame[row] = cells[:self.cols]
+        if not self._hw_lines:
+            self._hw_next_step = time.time() + self.SCROLL_DELAY
+        self._hw_lines[line] = string
+        self._hw_origin[line] = self._shift
 
+    # lengths are in characters, so UTF-8 text is decoded first
+    def _text(self, string):
+        if isinstance(string, str):
+            return string.decode('utf-8', 'replace')
+        return string
 
-    # put string function
+    # put string function, strings longer than the display scroll on scroll()
     def lcd_puts(self, string, line):
-        if len(string) > self.LCD_WIDTH:
-            while len(string) > 10:
-                self.lcd_string(string[:self.LCD_WIDTH], line)
-                string = string[1:]
-                time.sleep(0.3)
+        string = self._text(string)
+        if len(string) > self.cols and self._hw_scroll and \
+                len(string) + marquee.GAP <= self.DDRAM_WIDTH and self._hw_allowed(line):
+            self._marquee.pop(line, None)
+            if self._hw_lines.get(line) != string:
+                self._hw_lines.pop(line, None)
+                self._hw_load(string, line)
+        elif len(string) > self.cols:
+            self._hw_lines.pop(line, None)
+            converted = self._hw_stop()
+            m = self._marquee.get(line)
+            if m is None or m.text != string: # Keep scrolling if the text did not change
+                m = marquee(string, self.cols, self.SCROLL_DELAY)
+                self._marquee[line] = m
+                self.set_line(m.window(), line)
+                self.flush()
+            elif converted:
+                self.flush()
         else:
-            self.lcd_string(string, line)
+            self._marquee.pop(line, None)
+            self._hw_lines.pop(line, None)
+            if string.strip():
+                self._hw_stop()
+            self.set_line(string, line)
+            self.flush()
+
+    # a shift command moves every line, so hardware scrolling is only used
+    # while the other lines scroll that way too or are blank. A static line
+    # would have to be redrawn after every step.
+    def _hw_allowed(self, line):
+        blank = (0x20,) * self.cols
+        return all(other in self._hw_lines or
+                   (other not in self._marquee and self._frame[other - 1] == blank)
+                   for other in range(1, self.rows + 1) if other != line)
+
+    # turn the lines scrolled by the display into marquees that go on from
+    # where they are, returns True when the frame needs a flush()
+    def _hw_stop(self):
+        for line, string in self._hw_lines.items():
+            offset = (self._shift - self._hw_origin[line]) % self.DDRAM_WIDTH
+            m = marquee(string, self.cols, self.SCROLL_DELAY, offset)
+            m.next_step = self._hw_next_step
+            self._marquee[line] = m
+            self.set_line(m.window(), line)
+        converted = bool(self._hw_lines)
+        self._hw_lines = {}
+        return converted
+
+    # advance the scrolling lines by one step when due, never blocks
+    def scroll(self):
+        now = time.time()
+        dirty = False
+        for line, m in self._marquee.items():
+            if m.step(now):
+                self.set_line(m.window(), line)
+                dirty = True
+        if self._hw_lines and now >= self._hw_next_step:
+            # One command scrolls every line loaded in DDRAM, flush() then
+            # redraws whatever non scrolling line moved with them
+            self._lcd_byte(self.LCD_SHIFT_LEFT, self.LCD_CMD)
+            self._shift = (self._shift + 1) % self.DDRAM_WIDTH
+            self._hw_next_step = max(self._hw_next_step + self.SCROLL_DELAY, now)
+            dirty = True
+        if dirty:
+            self.flush()
+
+    # time.time() of the next scroll step, None when nothing scrolls
+    def next_scroll(self):
+        steps = [m.next_step for m in self._marquee.values()]
+        if self._hw_lines:
+            steps.append(self._hw_next_step)
+        return min(steps) if steps else None
+
+    # seconds a string needs to scroll once to its end
+    def scroll_time(self, string):
+        return max(0, len(self._text(string)) - self.cols) * self.SCROLL_DELAY
 
     # clear lcd and set to home
     def lcd_clear(self):
         self._lcd_byte(0x01,self.LCD_CMD) # 000001 Clear display
         #self._lcd_byte(0x02,self.LCD_CMD) # 000001 Clear display
-        time.sleep(self.E_DELAY)
+        if self._timing == self.TIMING_FIXED:
+            time.sleep(self.E_DELAY)
+        self._reset_shadow()
+        self._marquee = {}
+        self._hw_lines = {}
 
     def clear(self):
         self.lcd_clear()
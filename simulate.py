@@ -0,0 +1,293 @@
+'''
+In memory stand-ins for smbus and Adafruit_GPIO, to run pylcd2 and
+OneButton on a machine without the hardware (see benchmark.py).
+'''
+
+import time
+from threading import Thread, Lock
+
+# Same values as Adafruit_GPIO.GPIO
+OUT = 0
+IN = 1
+HIGH = True
+LOW = False
+RISING = 1
+FALLING = 2
+BOTH = 3
+PUD_OFF = 0
+PUD_DOWN = 1
+PUD_UP = 2
+
+
+class Backpack(object):
+    '''
+    A PCF8574 driving an HD44780 in the usual backpack wiring (RS=P0, RW=P1,
+    E=P2, backlight=P3, D4-D7=P4-P7). Keeps the display RAM and the busy
+    time of every instruction.
+    '''
+    RS = 0x01
+    RW = 0x02
+    E = 0x04
+
+    def __init__(self):
+        self.pins = 0xFF
+        self.commands = 0
+        self.writes = 0
+        self.violations = 0 # Instructions sent while the controller was busy
+        self.reset()
+
+    def reset(self):
+        # Controller state after power on
+        self.ddram = [0x20] * 0x80
+        self.cgram = [0] * 64
+        self.shift = 0
+        self._ac = 0
+        self._cgram_mode = False
+        self._increment = True
+        self._four_bit = False
+        self._nibble = None
+        self._read_nibble = 0
+        self._busy_until = 0.0
+
+    def write(self, byte, t):
+        if self.pins & self.E and not byte & self.E: # Falling edge latches
+            self._strobe(self.pins, t)
+        self.pins = byte
+
+    def read(self, t):
+        value = self.pins & 0x0F
+        if self.pins & self.RW and self.pins & self.E:
+            # The controller drives D4-D7 with the nibble being read
+            if self._read_nibble == 0:
+                value |= 0x80 if t < self._busy_until else 0
+                value |= (self._ac >> 4) & 0x70
+            else:
+                value |= (self._ac << 4) & 0xF0
+        else:
+            value |= self.pins & 0xF0
+        return value
+
+    def screen(self, cols=16, lines=2):
+        base = [0x00, 0x40, 0x14, 0x54]
+        return [''.join(chr(self.ddram[self._ddram_addr(base[line], (self.shift + col) % 40)])
+                        for col in range(cols)) for line in range(lines)]
+
+    def _strobe(self, pins, t):
+        if pins & self.RW:
+            self._read_nibble ^= 1
+            return
+        nibble = pins >> 4
+        if not self._four_bit:
+            # 8 bit mode, D0-D3 are not wired and read as 0
+            self._execute(nibble << 4, pins & self.RS, t)
+            return
+        if self._nibble is None:
+            self._nibble = nibble
+            return
+        value = (self._nibble << 4) | nibble
+        self._nibble = None
+        self._execute(value, pins & self.RS, t)
+
+    def _execute(self, value, rs, t):
+        if t < self._busy_until:
+            self.violations += 1
+        duration = 37e-6
+        if rs:
+            self.writes += 1
+            if self._cgram_mode:
+                self.cgram[self._ac & 0x3F] = value & 0x1F
+                self._ac = (self._ac + 1) & 0x3F
+            else:
+                self.ddram[self._ac] = value
+                self._move(1 if self._increment else -1)
+        else:
+            self.commands += 1
+            if value & 0x80: # Set DDRAM address
+                self._ac = value & 0x7F
+                self._cgram_mode = False
+            elif value & 0x40: # Set CGRAM address
+                self._ac = value & 0x3F
+                self._cgram_mode = True
+            elif value & 0x20: # Function set
+                self._four_bit = not value & 0x10
+            elif value & 0x10: # Cursor or display shift
+                step = 1 if value & 0x04 else -1
+                if value & 0x08:
+                    self.shift = (self.shift - step) % 40
+                else:
+                    self._move(step)
+            elif value & 0x04: # Entry mode
+                self._increment = bool(value & 0x02)
+            elif value & 0x02 or value & 0x01: # Home or clear
+                if value & 0x01:
+                    self.ddram = [0x20] * 0x80
+                    self._increment = True
+                self._ac = 0
+                self.shift = 0
+                self._cgram_mode = False
+                duration = 1.52e-3
+        self._read_nibble = 0
+        self._busy_until = t + duration
+
+    def _move(self, step):
+        # Advance the address counter over the two 40 cell lines
+        line = self._ac & 0x40
+        col = (self._ac & 0x3F) + step
+        if col >= 40:
+            col, line = 0, line ^ 0x40
+        elif col < 0:
+            col, line = 39, line ^ 0x40
+        self._ac = line | col
+
+    def _ddram_addr(self, base, col):
+        # Lines 3 and 4 of a 4 line display continue lines 1 and 2
+        return (base & 0x40) | ((base & 0x3F) + col) % 40
+
+
+class SMBus(object):
+    '''
+    An I2C bus with a Backpack at every address it is used with. The time
+    the bus takes is kept on a virtual clock that never runs behind the
+    real one, shared by all the devices like the wires are.
+    '''
+
+    def __init__(self, port=1, freq=100000):
+        self.port = port
+        self.devices = {} # addr -> Backpack
+        self._bit = 1.0 / freq
+        self._lock = Lock()
+        self._start = time.time()
+        self._now = 0.0 # Virtual seconds since start
+        # Statistics
+        self.transactions = 0
+        self.bytes = 0
+        self.bus_time = 0.0
+
+    def device(self, addr):
+        if addr not in self.devices:
+            self.devices[addr] = Backpack()
+        return self.devices[addr]
+
+    # smbus interface
+    def write_byte(self, addr, byte):
+        self._transaction(addr, [byte])
+
+    def write_i2c_block_data(self, addr, cmd, data):
+        self._transaction(addr, [cmd] + list(data))
+
+    def read_byte(self, addr):
+        with self._lock:
+            t = self._begin(1)
+            return self.device(addr).read(t)
+
+    def read_i2c_block_data(self, addr, cmd, n):
+        return [self.read_byte(addr) for i in range(n)]
+
+    def screen(self, addr=0x27, cols=16, lines=2):
+        '''The characters on the display at addr, one string per line'''
+        with self._lock:
+            return self.device(addr).screen(cols, lines)
+
+    def stats(self):
+        with self._lock:
+            devices = self.devices.values()
+            return {'transactions': self.transactions, 'bytes': self.bytes, 'bus_time': self.bus_time,
+                    'commands': sum(d.commands for d in devices), 'writes': sum(d.writes for d in devices),
+                    'violations': sum(d.violations for d in devices)}
+
+    def _begin(self, n):
+        # Start a transaction of n bytes, returns the virtual time of the first one
+        self._now = max(self._now, time.time() - self._start)
+        duration = (9 * (n + 1) + 2) * self._bit # Address byte, data, start and stop
+        self.transactions += 1
+        self.bytes += n
+        self.bus_time += duration
+        t = self._now + 10 * self._bit
+        self._now += duration
+        return t
+
+    def _transaction(self, addr, data):
+        with self._lock:
+            device = self.device(addr)
+            t = self._begin(len(data))
+            for byte in data:
+                t += 9 * self._bit
+                device.write(byte, t)
+
+
+class ScriptedGPIO(object):
+    '''
+    Board GPIO whose inputs follow a script of level changes. Every change
+    is kept in changes as (time, pin, level) to measure the delay of the
+    callbacks it causes.
+    '''
+
+    def __init__(self, levels=None):
+        self._levels = dict(levels or {})
+        self._edges = {}
+        self._callbacks = {}
+        self._lock = Lock()
+        self.changes = []
+
+    def setup(self, pin, mode, pull_up_down=PUD_OFF):
+        if pin not in self._levels:
+            self._levels[pin] = HIGH if pull_up_down == PUD_UP else LOW
+
+    def input(self, pin):
+        return self._levels[pin]
+
+    def input_pins(self, pins):
+        levels = self._levels
+        return [levels[pin] for pin in pins]
+
+    def output(self, pin, value):
+        self._levels[pin] = value
+
+    def add_event_detect(self, pin, edge):
+        self._edges[pin] = edge
+
+    def add_event_callback(self, pin, callback):
+        self._callbacks.setdefault(pin, []).append(callback)
+
+    def remove_event_detect(self, pin):
+        self._edges.pop(pin, None)
+        self._callbacks.pop(pin, None)
+
+    def set(self, pin, level):
+        '''Change the level of an input, calling its edge callbacks'''
+        with self._lock:
+            if self._levels.get(pin) == level:
+                return
+            self._levels[pin] = level
+            self.changes.append((time.time(), pin, level))
+            edge = self._edges.get(pin)
+            callbacks = list(self._callbacks.get(pin, ()))
+        if edge == BOTH or edge == (RISING if level else FALLING):
+            for callback in callbacks:
+                callback(pin)
+
+    def play(self, script):
+        '''
+        Replay script, a list of (seconds from now, pin, level), in a thread.
+        Returns the thread, join() it to wait for the end of the script.
+        '''
+        def run():
+            start = time.time()
+            for at, pin, level in sorted(script):
+                delay = start + at - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                self.set(pin, level)
+        player = Thread(target=run)
+        player.daemon = True
+        player.start()
+        return player
+
+
+def presses(pin, times, pressed=LOW):
+    '''Script pressing pin at each (start, duration) of times'''
+    script = []
+    for start, duration in times:
+        script.append((start, pin, pressed))
+        script.append((start + duration, pin, not pressed))
+    return script